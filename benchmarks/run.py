@@ -0,0 +1,448 @@
+'''
+Benchmarks for MagicFS, which drive FileSystem directly in-process, without
+mounting it.
+
+Results are written as JSON, and can be compared against the results of a
+previous run to find regressions:
+
+    $ PYTHONPATH=. python3 benchmarks/run.py -o before.json
+    $ PYTHONPATH=. python3 benchmarks/run.py -o after.json -c before.json
+'''
+
+import os
+import re
+import sys
+import json
+import time
+import timeit
+import argparse
+import platform
+import statistics
+import contextlib
+import tempfile
+
+from unittest import mock
+from types import SimpleNamespace
+
+import fuse
+
+from mafs import router
+from mafs import filesystem
+from mafs import file
+from mafs import MemoryMap
+
+BENCHMARKS = []
+
+# the size of files read and written, and of each read or write, which is
+# the largest that FUSE will ask for
+FILE_SIZE = 1024 * 1024
+CHUNK_SIZE = 128 * 1024
+
+
+def benchmark(name):
+    '''
+    Register a benchmark, as a function taking an ExitStack for cleaning up,
+    and returning a function to be timed.
+    '''
+
+    def decorator(func):
+        BENCHMARKS.append((name, func))
+        return func
+    return decorator
+
+
+# Router
+# ======
+
+def _routes(count, depth):
+    # a tree of static and variable routes, count routes deep
+    routes = []
+    for i in range(count):
+        parts = ['dir{}'.format(i % (count // 10 + 1))]
+        parts += ['sub{}'.format(j) for j in range(depth - 2)]
+        parts.append('file{}'.format(i))
+        routes.append('/' + '/'.join(parts))
+    routes.append('/' + '/'.join(':var{}'.format(j) for j in range(depth)))
+    return routes
+
+
+for _count, _depth in [(10, 2), (1000, 2), (1000, 8), (10000, 8), (100, 32)]:
+    def _router(stack, count=_count, depth=_depth, cache_size=0):
+        r = router.Router(cache_size=cache_size)
+        routes = _routes(count, depth)
+        for route in routes:
+            r.add(route, route)
+
+        static = routes[count // 2]
+        variable = '/' + '/'.join('x' for _ in range(depth))
+
+        def run():
+            r.resolve(static)
+            r.resolve(variable)
+        return run
+
+    name = 'router/resolve/routes={},depth={}'.format(_count, _depth)
+    benchmark(name)(_router)
+    benchmark(name + ',cached')(
+        lambda stack, f=_router: f(stack, cache_size=1024))
+
+
+@benchmark('router/add/routes=1000,depth=8')
+def _router_add(stack):
+    routes = _routes(1000, 8)
+
+    def run():
+        r = router.Router()
+        for route in routes:
+            r.add(route, route)
+    return run
+
+
+# Attributes
+# ==========
+
+@benchmark('getattr/static')
+def _getattr_static(stack):
+    fs = filesystem.FileSystem()
+    fs.onread('/folder/file', lambda path, ps: 'contents')
+    return lambda: fs.getattr('/folder/file')
+
+
+@benchmark('getattr/variable')
+def _getattr_variable(stack):
+    fs = filesystem.FileSystem()
+    fs.onread('/folder/:name', lambda path, ps: 'contents')
+    return lambda: fs.getattr('/folder/file')
+
+
+@benchmark('getattr/directory')
+def _getattr_directory(stack):
+    fs = filesystem.FileSystem()
+    fs.onread('/folder/file', lambda path, ps: 'contents')
+    return lambda: fs.getattr('/folder')
+
+
+@benchmark('getattr/stat')
+def _getattr_stat(stack):
+    fs = filesystem.FileSystem()
+    fs.onread('/file', lambda path, ps: 'contents')
+    fs.onstat('/file', lambda path, ps: {'st_size': 8})
+    return lambda: fs.getattr('/file')
+
+
+@benchmark('getattr/stat,ttl')
+def _getattr_stat_ttl(stack):
+    fs = filesystem.FileSystem()
+    fs.onread('/file', lambda path, ps: 'contents')
+    fs.onstat('/file', lambda path, ps: {'st_size': 8}, ttl=3600)
+    return lambda: fs.getattr('/file')
+
+
+@benchmark('getattr/missing')
+def _getattr_missing(stack):
+    fs = filesystem.FileSystem()
+    fs.onread('/file', lambda path, ps: 'contents')
+
+    def run():
+        try:
+            fs.getattr('/missing')
+        except fuse.FuseOSError:
+            pass
+    return run
+
+
+for _hooks in ['none', 'metrics']:
+    @benchmark('dispatch/getattr,hooks={}'.format(_hooks))
+    def _dispatch(stack, hooks=_hooks):
+        fs = filesystem.FileSystem(metrics=hooks == 'metrics')
+        fs.onread('/file', lambda path, ps: 'contents')
+        return lambda: fs('getattr', '/file')
+
+
+# Directories
+# ===========
+
+def _readdir(fs, path):
+    def run():
+        fh = fs.opendir(path)
+        for _ in fs.readdir(path, fh):
+            pass
+        fs.releasedir(path, fh)
+    return run
+
+
+for _count in [10, 1000]:
+    @benchmark('readdir/static,entries={}'.format(_count))
+    def _readdir_static(stack, count=_count):
+        fs = filesystem.FileSystem()
+        for i in range(count):
+            fs.onread('/folder/file{}'.format(i), lambda path, ps: 'contents')
+        return _readdir(fs, '/folder')
+
+    @benchmark('readdir/list,entries={}'.format(_count))
+    def _readdir_list(stack, count=_count):
+        names = ['file{}'.format(i) for i in range(count)]
+
+        fs = filesystem.FileSystem()
+        fs.onread('/folder/:name', lambda path, ps: 'contents')
+        fs.onlist('/folder', lambda path, ps: names)
+        return _readdir(fs, '/folder')
+
+    @benchmark('readdir/list,entries={},attrs'.format(_count))
+    def _readdir_attrs(stack, count=_count):
+        entries = [('file{}'.format(i), {'st_size': i}) for i in range(count)]
+
+        fs = filesystem.FileSystem()
+        fs.onread('/folder/:name', lambda path, ps: 'contents')
+        fs.onlist('/folder', lambda path, ps: entries)
+        return _readdir(fs, '/folder')
+
+
+# Readers
+# =======
+
+def _temporary(stack, data):
+    f = stack.enter_context(tempfile.NamedTemporaryFile())
+    f.write(data)
+    f.flush()
+    return f.name
+
+
+def _read(fs, path):
+    def run():
+        fi = SimpleNamespace(flags=os.O_RDONLY)
+        fs.open(path, fi)
+        offset = 0
+        while True:
+            data = fs.read(path, CHUNK_SIZE, offset, fi)
+            if not data:
+                break
+            offset += len(data)
+        fs.release(path, fi)
+    return run
+
+
+def _reader(name, encoding='utf-8', **options):
+    def decorator(contents):
+        @benchmark('read/' + name)
+        def setup(stack):
+            fs = filesystem.FileSystem()
+            stack.callback(fs.destroy, '/')
+            fs.onread('/file', contents(stack), encoding, **options)
+            return _read(fs, '/file')
+        return contents
+    return decorator
+
+
+@_reader('raw')
+def _read_raw(stack):
+    data = 'x' * FILE_SIZE
+    return lambda path, ps: data
+
+
+@_reader('buffer', None)
+def _read_buffer(stack):
+    data = bytes(FILE_SIZE)
+    return lambda path, ps: data
+
+
+@_reader('mapped', None)
+def _read_mapped(stack):
+    name = _temporary(stack, bytes(FILE_SIZE))
+    return lambda path, ps: MemoryMap(name)
+
+
+@_reader('file', None)
+def _read_file(stack):
+    name = _temporary(stack, bytes(FILE_SIZE))
+    return lambda path, ps: open(name, 'rb')
+
+
+def _function(stack):
+    data = bytes(FILE_SIZE)
+
+    def contents(path, ps):
+        return lambda length, offset: data[offset:offset + length]
+    return contents
+
+
+_reader('function', None)(_function)
+_reader('function,readahead', None,
+        readahead=file.FileReader.Readahead.WINDOW)(_function)
+_reader('function,block_cache', None, block_cache=True)(_function)
+
+
+def _iterable(stack):
+    chunk = bytes(64 * 1024)
+
+    def contents(path, ps):
+        return (chunk for _ in range(FILE_SIZE // len(chunk)))
+    return contents
+
+
+_reader('iterable', None)(_iterable)
+_reader('iterable,readahead', None,
+        readahead=file.FileReader.Readahead.WINDOW)(_iterable)
+_reader('iterable,sequential', None, sequential=True)(_iterable)
+
+
+# Writers
+# =======
+
+def _write(fs, path):
+    data = bytes(CHUNK_SIZE)
+
+    def run():
+        fi = SimpleNamespace(flags=os.O_WRONLY)
+        fs.open(path, fi)
+        for offset in range(0, FILE_SIZE, CHUNK_SIZE):
+            fs.write(path, data, offset, fi)
+        fs.release(path, fi)
+    return run
+
+
+def _writer(name, encoding=None, **options):
+    def decorator(contents):
+        @benchmark('write/' + name)
+        def setup(stack):
+            fs = filesystem.FileSystem()
+            stack.callback(fs.destroy, '/')
+            fs.onwrite('/file', contents(stack), encoding, **options)
+            return _write(fs, '/file')
+        return contents
+    return decorator
+
+
+@_writer('function')
+def _write_function(stack):
+    def contents(path, ps):
+        return lambda data, offset: None
+    return contents
+
+
+def _full(stack):
+    def contents(path, ps):
+        return lambda data: None
+    return contents
+
+
+_writer('full')(_full)
+_writer('full,text', 'utf-8')(_full)
+_writer('full,spill', spill_size=FILE_SIZE // 4)(_full)
+
+
+@_writer('stream')
+def _write_stream(stack):
+    def contents(path, ps):
+        while True:
+            yield
+    return contents
+
+
+@_writer('file')
+def _write_file(stack):
+    name = _temporary(stack, bytes())
+    return lambda path, ps: open(name, 'r+b')
+
+
+# Running
+# =======
+
+def run(pattern=None, repeat=5, duration=0.2):
+    results = {}
+
+    with mock.patch('fuse.fuse_get_context',
+                    lambda: (os.getuid(), os.getgid(), os.getpid())):
+        for name, setup in BENCHMARKS:
+            if pattern and not re.search(pattern, name):
+                continue
+
+            with contextlib.ExitStack() as stack:
+                timer = timeit.Timer(setup(stack))
+
+                # find a number of calls that take long enough to time
+                number = 1
+                while True:
+                    elapsed = timer.timeit(number)
+                    if elapsed >= duration:
+                        break
+                    number *= 10 if elapsed < duration / 10 else 2
+
+                times = [elapsed / number
+                         for elapsed in timer.repeat(repeat, number)]
+
+            results[name] = {
+                'seconds': min(times),
+                'median': statistics.median(times),
+                'number': number,
+                'repeat': repeat,
+            }
+            print('{:48} {:>12.3f} us'.format(name, min(times) * 1e6),
+                  file=sys.stderr)
+
+    return {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'time': time.time(),
+        'benchmarks': results,
+    }
+
+
+def compare(results, baseline, threshold):
+    '''
+    Compare results with a baseline, returning the names of the benchmarks
+    that are slower by more than the threshold (a fraction).
+    '''
+
+    regressions = []
+    for name, result in results['benchmarks'].items():
+        before = baseline['benchmarks'].get(name)
+        if not before:
+            continue
+
+        ratio = result['seconds'] / before['seconds']
+        marker = ''
+        if ratio > 1 + threshold:
+            marker = ' (regression)'
+            regressions.append(name)
+        print('{:48} {:>8.2f}x{}'.format(name, ratio, marker),
+              file=sys.stderr)
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip(),
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-o', '--output',
+                        help='file to write results to (default: stdout)')
+    parser.add_argument('-c', '--compare', metavar='BASELINE',
+                        help='results of a previous run to compare against')
+    parser.add_argument('-t', '--threshold', type=float, default=0.25,
+                        help='fraction slower counted as a regression')
+    parser.add_argument('-k', '--filter', metavar='PATTERN',
+                        help='only run benchmarks matching a regex')
+    parser.add_argument('-r', '--repeat', type=int, default=5,
+                        help='number of times to repeat each benchmark')
+    args = parser.parse_args()
+
+    results = run(args.filter, args.repeat)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
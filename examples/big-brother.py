@@ -23,28 +23,18 @@ def write(path, ps):
     return open(prefix(path), 'wb')
 
 
-@fs.stat('*file')
+@fs.stat('*file', ttl=1)
 def stat(path, ps):
     print('stat', path)
-    stat = os.stat(prefix(path))
-
-    return {
-        'st_mode': stat.st_mode,
-        'st_nlink': stat.st_nlink,
-        'st_uid': stat.st_uid,
-        'st_gid': stat.st_gid,
-        'st_size': stat.st_size,
-        'st_atime': stat.st_atime,
-        'st_mtime': stat.st_mtime,
-        'st_ctime': stat.st_ctime
-    }
+    return os.stat(prefix(path))
 
 
 @fs.list('/')
 @fs.list('*file')
 def list(path, ps):
     print('list', path)
-    return os.listdir(prefix(path))
+    for entry in os.scandir(prefix(path)):
+        yield entry.name, entry.stat(follow_symlinks=False)
 
 
 fs.run()
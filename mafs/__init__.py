@@ -1,4 +1,8 @@
 from .mafs import MagicFS
 from .mafs import FileType
+from .file import MemoryMap
+from .hooks import Hook
+from .manifest import Manifest
 
-__all__ = ['MagicFS', 'FileNotFoundError', 'FileType']
+__all__ = ['MagicFS', 'FileNotFoundError', 'FileType', 'MemoryMap', 'Hook',
+           'Manifest']
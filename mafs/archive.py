@@ -0,0 +1,253 @@
+import os
+import abc
+import errno
+import struct
+import sqlite3
+import tarfile
+import zipfile
+import posixpath
+import threading
+
+from collections import namedtuple
+from urllib.parse import quote
+
+import fuse
+
+from .manifest import Manifest
+
+# a file in an archive, with its size, the offset of its data in the
+# archive file if it can be read directly, and a key to find it by otherwise
+Member = namedtuple('Member', ['size', 'offset', 'key'])
+
+
+def open_archive(path, table=None, **options):
+    '''
+    Open an archive, detecting whether it is a zip, tar or SQLite file.
+
+    SQLite archives need the name of the table that holds their files.
+    '''
+
+    with open(path, 'rb') as f:
+        header = f.read(len(_SQLITE_HEADER))
+
+    if header == _SQLITE_HEADER:
+        if table is None:
+            raise ArchiveError('a table is needed for SQLite archives')
+        return SQLiteArchive(path, table, **options)
+    if zipfile.is_zipfile(path):
+        return ZipArchive(path)
+    if tarfile.is_tarfile(path):
+        return TarArchive(path)
+
+    raise ArchiveError(path + ' is not a supported archive')
+
+
+class Archive(abc.ABC):
+    '''
+    A read-only archive of files, indexed once when opened.
+
+    The index is kept as a Manifest of Members, and the contents of each
+    member are opened with read().
+    '''
+
+    def __init__(self, manifest):
+        self.manifest = manifest
+
+    def read(self, name):
+        member = self.manifest.get(name)
+        if member is None:
+            raise fuse.FuseOSError(errno.ENOENT)
+        return self.open(member)
+
+    @abc.abstractmethod
+    def open(self, member):
+        pass
+
+    def close(self):
+        pass
+
+
+class ZipArchive(Archive):
+    '''
+    A zip file, with uncompressed members read directly from the file, and
+    compressed members decompressed as they are read.
+    '''
+
+    def __init__(self, path):
+        self.zip = zipfile.ZipFile(path)
+        self.fd = os.open(path, os.O_RDONLY)
+
+        # the offset of stored data is only found once it is opened, as it
+        # needs the local header of the member
+        super().__init__(Manifest(
+            (info.filename, Member(info.file_size, None, info))
+            for info in self.zip.infolist() if not info.is_dir()))
+
+    def open(self, member):
+        info = member.key
+        if info.compress_type != zipfile.ZIP_STORED or info.flag_bits & 0x1:
+            return self.zip.open(info)
+
+        header = os.pread(self.fd, _ZIP_HEADER.size, info.header_offset)
+        if len(header) < _ZIP_HEADER.size:
+            raise ArchiveError(info.filename + ' has a truncated header')
+        signature, name_length, extra_length = _ZIP_HEADER.unpack(header)
+        if signature != b'PK\x03\x04':
+            raise ArchiveError(info.filename + ' has a bad header')
+
+        start = info.header_offset + _ZIP_HEADER.size + name_length + \
+            extra_length
+        return _slice(self.fd, start, member.size)
+
+    def close(self):
+        self.zip.close()
+        os.close(self.fd)
+
+
+class TarArchive(Archive):
+    '''
+    A tar file, with members of uncompressed archives read directly from the
+    file, and members of compressed archives decompressed as they are read.
+
+    Compressed archives cannot be read from at random, so reading a member
+    may need to decompress everything before it.
+    '''
+
+    def __init__(self, path):
+        try:
+            self.tar = tarfile.open(path, 'r:')
+            compressed = False
+        except tarfile.ReadError:
+            self.tar = tarfile.open(path, 'r:*')
+            compressed = True
+
+        self.fd = os.open(path, os.O_RDONLY)
+        self.lock = threading.Lock()
+
+        # names are often relative to '.', and later members replace
+        # earlier ones with the same name, as when extracting
+        members = {}
+        for info in self.tar.getmembers():
+            if not info.isfile():
+                continue
+
+            offset = None
+            if not compressed and not info.issparse():
+                offset = info.offset_data
+            name = posixpath.normpath('/' + info.name).lstrip('/')
+            members[name] = Member(info.size, offset, info)
+        super().__init__(Manifest(members))
+
+    def open(self, member):
+        if member.offset is not None:
+            return _slice(self.fd, member.offset, member.size)
+
+        # members share the decompressed stream of the archive
+        file = self.tar.extractfile(member.key)
+
+        def read(length, offset):
+            with self.lock:
+                file.seek(offset)
+                return file.read(length)
+        return read
+
+    def close(self):
+        self.tar.close()
+        os.close(self.fd)
+
+
+class SQLiteArchive(Archive):
+    '''
+    A table in an SQLite database, with a row for each file, holding its
+    path in one column and its contents in another.
+
+    Contents are read in parts as they are needed using incremental blob
+    I/O, which reads only the requested range. Before Python 3.11, which has
+    no blob I/O, each read selects a substring of the contents instead,
+    which makes SQLite load the whole value for every read.
+    '''
+
+    def __init__(self, path, table, name='name', data='data'):
+        self.uri = 'file:' + quote(os.path.abspath(path)) + '?mode=ro'
+        self.table = table
+        self.data = data
+
+        # connections cannot be shared between threads
+        self.local = threading.local()
+        self.connections = []
+        self.lock = threading.Lock()
+
+        table, name, data = _identifier(table), _identifier(name), \
+            _identifier(data)
+        self.query = 'SELECT substr(CAST({} AS BLOB), ?, ?) FROM {} ' \
+            'WHERE rowid = ?'.format(data, table)
+
+        rows = self._connection().execute(
+            'SELECT rowid, {}, length(CAST({} AS BLOB)) FROM {}'.format(
+                name, data, table))
+        super().__init__(Manifest(
+            (path, Member(size or 0, None, rowid))
+            for rowid, path, size in rows))
+
+    def open(self, member):
+        # each thread reading the file has its own handle on its contents
+        blobs = threading.local()
+
+        def read(length, offset):
+            length = min(length, member.size - offset)
+            if length <= 0:
+                return bytes()
+
+            connection = self._connection()
+            if not hasattr(connection, 'blobopen'):
+                row = connection.execute(
+                    self.query, (offset + 1, length, member.key)).fetchone()
+                return row[0] if row and row[0] else bytes()
+
+            blob = getattr(blobs, 'blob', None)
+            if blob is None:
+                blob = blobs.blob = connection.blobopen(
+                    self.table, self.data, member.key, readonly=True)
+            blob.seek(offset)
+            return blob.read(length)
+        return read
+
+    def close(self):
+        with self.lock:
+            for connection in self.connections:
+                connection.close()
+            self.connections = []
+
+    def _connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.uri, uri=True,
+                                         check_same_thread=False)
+            self.local.connection = connection
+            with self.lock:
+                self.connections.append(connection)
+        return connection
+
+
+class ArchiveError(Exception):
+    pass
+
+
+_SQLITE_HEADER = b'SQLite format 3\x00'
+
+# the signature and lengths of the name and extra field of a local header
+_ZIP_HEADER = struct.Struct('<4s22xHH')
+
+
+def _slice(fd, start, size):
+    # read part of a file, without a file object of its own
+    def read(length, offset):
+        length = min(length, size - offset)
+        if length <= 0:
+            return bytes()
+        return os.pread(fd, length, start + offset)
+    return read
+
+
+def _identifier(name):
+    return '"' + name.replace('"', '""') + '"'
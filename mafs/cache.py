@@ -0,0 +1,123 @@
+import time
+import threading
+
+from collections import OrderedDict
+
+
+class TTLCache:
+    '''
+    A bounded mapping whose entries expire after a time to live.
+
+    Once full, the least recently used entries are evicted first.
+    '''
+
+    def __init__(self, maxsize=4096, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.clock = clock
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+
+            expiry, value = entry
+            if expiry is not None and expiry <= self.clock():
+                del self._entries[key]
+                return default
+
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        expiry = None if ttl is None else self.clock() + ttl
+        with self._lock:
+            self._entries[key] = (expiry, value)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class BlockCache:
+    '''
+    A cache of fixed size blocks of file contents, keyed by path and block
+    index, shared between all open files.
+
+    The total size of all blocks is limited by the capacity; once full, the
+    least recently used blocks are evicted first.
+    '''
+
+    def __init__(self, capacity=64 * 1024 * 1024, block_size=128 * 1024):
+        self.capacity = capacity
+        self.block_size = block_size
+
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+        self._blocks = OrderedDict()
+        self._paths = {}
+        self._lock = threading.Lock()
+
+    def get(self, path, index):
+        with self._lock:
+            block = self._blocks.get((path, index))
+            if block is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self._blocks.move_to_end((path, index))
+            return block
+
+    def set(self, path, index, block):
+        if len(block) > self.capacity:
+            return
+
+        with self._lock:
+            self._remove((path, index))
+            self._blocks[(path, index)] = block
+            self._paths.setdefault(path, set()).add(index)
+            self.size += len(block)
+
+            while self.size > self.capacity:
+                key = next(iter(self._blocks))
+                self._remove(key)
+
+    def invalidate(self, path=None):
+        with self._lock:
+            if path is None:
+                self._blocks.clear()
+                self._paths.clear()
+                self.size = 0
+            else:
+                for index in tuple(self._paths.get(path, ())):
+                    self._remove((path, index))
+
+    def _remove(self, key):
+        block = self._blocks.pop(key, None)
+        if block is None:
+            return
+
+        self.size -= len(block)
+
+        path, index = key
+        indexes = self._paths[path]
+        indexes.discard(index)
+        if not indexes:
+            del self._paths[path]
@@ -1,15 +1,25 @@
+import os
+import mmap
+import heapq
+import codecs
 import errno
 import fuse
+import array
+import bisect
 import inspect
+import tempfile
+import threading
+
+from multiprocessing import shared_memory
 
 
 class FileReader:
-    def create(contents, encoding):
-        READERS = [FileReader.Raw, FileReader.File,
-                   FileReader.Function, FileReader.Iterable]
+    def create(contents, encoding, **options):
+        READERS = [FileReader.Mapped, FileReader.Buffer, FileReader.Raw,
+                   FileReader.File, FileReader.Function, FileReader.Iterable]
 
         for reader in READERS:
-            r = reader.create(contents, encoding)
+            r = reader.create(contents, encoding, **options)
             if r:
                 return r
 
@@ -17,7 +27,7 @@ class FileReader:
 
     class Raw:
         @staticmethod
-        def create(contents, encoding):
+        def create(contents, encoding, **options):
             try:
                 return FileReader.Raw(contents.encode(encoding))
             except AttributeError:
@@ -29,12 +39,75 @@ class FileReader:
         def read(self, length, offset):
             return self.contents[offset:offset + length]
 
+        def size(self):
+            return len(self.contents)
+
         def release(self):
             pass
 
+    class Buffer:
+        @staticmethod
+        def create(contents, encoding, **options):
+            try:
+                view = memoryview(contents)
+            except TypeError:
+                return None
+
+            # buffers that can be resized are copied, since they cannot be
+            # resized while a view of them is held
+            if isinstance(contents, (bytearray, array.array)):
+                view = memoryview(view.tobytes())
+
+            # serve items of any format as raw bytes
+            if view.format != 'B' or view.ndim != 1:
+                try:
+                    view = view.cast('B')
+                except TypeError:
+                    # not contiguous, so must be copied
+                    view = memoryview(view.tobytes())
+            return FileReader.Buffer(view)
+
+        def __init__(self, view):
+            self.view = view
+
+        def read(self, length, offset):
+            return self.view[offset:offset + length]
+
+        def size(self):
+            return self.view.nbytes
+
+        def release(self):
+            self.view.release()
+
+    class Mapped:
+        @staticmethod
+        def create(contents, encoding, **options):
+            if isinstance(contents, MemoryMap):
+                return FileReader.Mapped(contents.map())
+            if isinstance(contents, mmap.mmap):
+                return FileReader.Mapped(contents)
+
+        def __init__(self, mapping):
+            # empty files cannot be mapped, so have no mapping
+            self.mapping = mapping
+
+        def read(self, length, offset):
+            if self.mapping is None:
+                return bytes()
+            return self.mapping[offset:offset + length]
+
+        def size(self):
+            if self.mapping is None:
+                return 0
+            return len(self.mapping)
+
+        def release(self):
+            if self.mapping is not None:
+                self.mapping.close()
+
     class File:
         @staticmethod
-        def create(contents, encoding):
+        def create(contents, encoding, **options):
             if hasattr(contents, 'read') and hasattr(contents, 'write'):
                 return FileReader.File(contents, encoding)
 
@@ -42,19 +115,36 @@ class FileReader:
             self.file = file
             self.encoding = encoding
 
+            # byte files backed by a descriptor can be read directly, once
+            # anything still buffered has been written out
+            self.fd = None if encoding else _fileno(file)
+            if self.fd is not None:
+                self.file.flush()
+            self.lock = threading.Lock()
+
         def read(self, length, offset):
-            self.file.seek(offset)
-            data = self.file.read(length)
+            if self.fd is not None:
+                return os.pread(self.fd, length, offset)
+
+            with self.lock:
+                self.file.seek(offset)
+                data = self.file.read(length)
             if self.encoding:
                 data = data.encode(self.encoding)
             return data
 
+        def size(self):
+            # the encoded length of text files is not known
+            if self.fd is None:
+                return None
+            return os.fstat(self.fd).st_size
+
         def release(self):
             self.file.close()
 
     class Function:
         @staticmethod
-        def create(contents, encoding):
+        def create(contents, encoding, **options):
             if hasattr(contents, '__call__') and _arg_count(contents) == 2:
                 return FileReader.Function(contents, encoding)
 
@@ -65,51 +155,313 @@ class FileReader:
         def read(self, length, offset):
             return self.func(length, offset)
 
+        def size(self):
+            return None
+
         def release(self):
             pass
 
     class Iterable:
         @staticmethod
-        def create(contents, encoding):
+        def create(contents, encoding, sequential=False, **options):
             try:
-                return FileReader.Iterable(iter(contents), encoding)
+                return FileReader.Iterable(iter(contents), encoding,
+                                           sequential)
             except TypeError:
                 return None
 
-        def __init__(self, iterable, encoding):
+        def __init__(self, iterable, encoding, sequential=False):
             self.generator = iterable
-            self.cache = bytes()
             self.encoding = encoding
 
+            # in sequential mode, data behind the latest read is discarded
+            self.sequential = sequential
+
+            # produced data, kept as segments to avoid joining them together
+            self.segments = []
+            self.offsets = []
+            self.start = 0
+            self.end = 0
+            self.lock = threading.Lock()
+
+            # offsets of reads in progress, which must not be discarded
+            self.outstanding = []
+            self.outstanding_lock = threading.Lock()
+
         def read(self, length, offset):
-            # read data into cache if provided by an iterable
-            while self.generator and len(self.cache) < offset + length:
+            with self.outstanding_lock:
+                self.outstanding.append(offset)
+
+            try:
+                with self.lock:
+                    return self._read(length, offset)
+            finally:
+                with self.outstanding_lock:
+                    self.outstanding.remove(offset)
+
+        def _read(self, length, offset):
+            # read data into segments if provided by an iterable
+            while self.generator and self.end < offset + length:
                 try:
                     part = next(self.generator)
                     if self.encoding:
                         part = part.encode(self.encoding)
-                    self.cache += part
+                    if part:
+                        self.segments.append(part)
+                        self.offsets.append(self.end)
+                        self.end += len(part)
                 except StopIteration:
                     self.generator = None
 
-            # provide requested data from the cache
-            return self.cache[offset:offset + length]
+            if offset < self.start:
+                # data has already been discarded
+                raise fuse.FuseOSError(errno.ESPIPE)
+
+            data = self._slice(length, offset)
+            if self.sequential:
+                with self.outstanding_lock:
+                    lowest = min(self.outstanding)
+                self._discard(lowest)
+            return data
+
+        def _slice(self, length, offset):
+            end = min(offset + length, self.end)
+            if offset >= end:
+                return bytes()
+
+            first = bisect.bisect_right(self.offsets, offset) - 1
+            last = bisect.bisect_left(self.offsets, end)
+
+            if last - first == 1:
+                # the common case, the data is entirely in one segment
+                start = self.offsets[first]
+                segment = self.segments[first]
+                if offset == start and end - start == len(segment):
+                    return segment
+                return segment[offset - start:end - start]
+
+            parts = []
+            for i in range(first, last):
+                start = self.offsets[i]
+                segment = memoryview(self.segments[i])
+                parts.append(segment[max(offset - start, 0):end - start])
+            return bytes().join(parts)
+
+        def _discard(self, offset):
+            # keep the segment containing offset, since reads may be retried
+            count = bisect.bisect_right(self.offsets, offset) - 1
+            if count > 0:
+                del self.segments[:count]
+                del self.offsets[:count]
+                self.start = self.offsets[0]
+
+        def size(self):
+            return None
 
         def release(self):
             pass
 
+    class Shared:
+        def __init__(self, name, size):
+            self.memory = shared_memory.SharedMemory(name)
+            self.view = self.memory.buf[:size]
+
+        def read(self, length, offset):
+            return self.view[offset:offset + length]
+
+        def size(self):
+            return self.view.nbytes
+
+        def release(self):
+            self.view.release()
+            self.memory.close()
+            self.memory.unlink()
+
+    class Readahead:
+        WINDOW = 1024 * 1024
+
+        def __init__(self, reader, executor, window=WINDOW):
+            self.reader = reader
+            self.executor = executor
+            self.window = window
+
+            # where the next read is expected, if reading sequentially
+            self.position = 0
+            self.sequential = 0
+
+            # data read ahead, starting at start, and the window that is
+            # still being read (which always follows on from the buffer)
+            self.buffer = bytes()
+            self.start = 0
+            self.pending = None
+
+            # where the data was last seen to end, which may later grow
+            self.eof = None
+
+            self.lock = threading.Lock()
+            self.reading = threading.Lock()
+
+        def read(self, length, offset):
+            with self.lock:
+                if offset == self.position:
+                    self.sequential += 1
+                else:
+                    self.sequential = 0
+
+                end = self.start + len(self.buffer)
+                if self.pending and offset + length > end:
+                    self._merge()
+                    end = self.start + len(self.buffer)
+
+                if self.start <= offset < end:
+                    index = offset - self.start
+                    data = self.buffer[index:index + length]
+                    if len(data) < length:
+                        data += self._read(length - len(data), end)
+                        self.buffer = bytes()
+                        self.start = offset + len(data)
+                else:
+                    data = self._read(length, offset)
+                    if not self.pending:
+                        self.buffer = bytes()
+                        self.start = offset + len(data)
+
+                self.position = offset + len(data)
+
+                # keep a window ahead of sequential reads, unless they have
+                # reached the end of the data (and it has not since grown)
+                end = self.start + len(self.buffer)
+                ahead = end - self.position
+                ended = self.eof is not None and self.position <= self.eof
+                if self.sequential >= 2 and not self.pending and \
+                        not ended and ahead < self.window:
+                    self.pending = self.executor.submit(self._read,
+                                                        self.window, end)
+
+                return data
+
+        def size(self):
+            return None
+
+        def release(self):
+            with self.lock:
+                if self.pending and not self.pending.cancel():
+                    try:
+                        self.pending.result()
+                    except Exception:
+                        pass
+                self.pending = None
+
+            self.reader.release()
+
+        def _merge(self):
+            pending = self.pending
+            self.pending = None
+            data = pending.result()
+
+            # drop what has already been read
+            index = min(max(self.position - self.start, 0), len(self.buffer))
+            end = self.start + len(self.buffer)
+            self.buffer = self.buffer[index:] + data
+            self.start += index
+
+            if len(data) < self.window:
+                self.eof = end + len(data)
+
+        def _read(self, length, offset):
+            # readers may return less than requested before the end of file
+            parts = []
+            with self.reading:
+                while length > 0:
+                    data = self.reader.read(length, offset)
+                    if not data:
+                        break
+                    parts.append(data)
+                    length -= len(data)
+                    offset += len(data)
+
+            return bytes().join(parts)
+
+    class Cached:
+        def __init__(self, create, cache, path):
+            # the reader is only created once a block is not in the cache
+            self.create = create
+            self.reader = None
+
+            self.cache = cache
+            self.path = path
+            self.lock = threading.Lock()
+
+        def read(self, length, offset):
+            size = self.cache.block_size
+            first = offset // size
+            last = (offset + length - 1) // size
+
+            blocks = []
+            for index in range(first, last + 1):
+                block = self.cache.get(self.path, index)
+                if block is None:
+                    block = self._read_block(index)
+                    self.cache.set(self.path, index, block)
+
+                blocks.append(block)
+                if len(block) < size:
+                    # reached the end of the file
+                    break
+
+            if not blocks:
+                return bytes()
+            data = blocks[0] if len(blocks) == 1 else bytes().join(blocks)
+
+            start = offset - first * size
+            return data[start:start + length]
+
+        def size(self):
+            if self.reader:
+                return self.reader.size()
+            return None
+
+        def release(self):
+            if self.reader:
+                self.reader.release()
+
+        def _read_block(self, index):
+            if self.reader is None:
+                with self.lock:
+                    if self.reader is None:
+                        self.reader = self.create() or False
+            if not self.reader:
+                return bytes()
+
+            size = self.cache.block_size
+            offset = index * size
+
+            # readers may return less than requested before the end of file
+            parts = []
+            remaining = size
+            while remaining > 0:
+                data = self.reader.read(remaining, offset + size - remaining)
+                if not data:
+                    break
+                parts.append(bytes(data))
+                remaining -= len(data)
+            return bytes().join(parts)
+
 
 class FileWriter:
-    def create(contents, encoding):
-        for writer in [FileWriter.Function, FileWriter.Full, FileWriter.File]:
-            w = writer.create(contents, encoding)
+    def create(contents, encoding, **options):
+        WRITERS = [FileWriter.Function, FileWriter.Full, FileWriter.Stream,
+                   FileWriter.File]
+
+        for writer in WRITERS:
+            w = writer.create(contents, encoding, **options)
             if w:
                 return w
 
         raise FileError(str(contents) + ' cannot be used as a file writer')
 
     class Function:
-        def create(contents, encoding):
+        def create(contents, encoding, **options):
             if hasattr(contents, '__call__') and _arg_count(contents) == 2:
                 return FileWriter.Function(contents)
 
@@ -124,33 +476,151 @@ class FileWriter:
             pass
 
     class Full:
-        def create(contents, encoding):
+        SPILL_SIZE = 16 * 1024 * 1024
+
+        def create(contents, encoding, spill_size=SPILL_SIZE, **options):
             if hasattr(contents, '__call__') and _arg_count(contents) == 1:
-                return FileWriter.Full(contents, encoding)
+                return FileWriter.Full(contents, encoding, spill_size)
 
-        def __init__(self, callback, encoding):
+        def __init__(self, callback, encoding, spill_size=SPILL_SIZE):
             self.callback = callback
             self.encoding = encoding
 
-            self.cache = []
+            # written data is kept in memory, until it grows beyond the spill
+            # size, at which point it is moved to a temporary file
+            self.spill_size = spill_size
+            self.cache = bytearray()
+            self.spill = None
+            self.lock = threading.Lock()
 
         def write(self, data, offset):
-            # extend cache size
-            ldiff = len(data) - len(self.cache)
-            if ldiff > 0:
-                self.cache.extend([None] * ldiff)
+            with self.lock:
+                return self._write(data, offset)
+
+        def _write(self, data, offset):
+            end = offset + len(data)
+
+            if self.spill is None and self.spill_size is not None and \
+                    end > self.spill_size:
+                self.spill = tempfile.TemporaryFile()
+                self.spill.write(self.cache)
+                self.spill.flush()
+                self.cache = None
+
+            if self.spill is not None:
+                os.pwrite(self.spill.fileno(), data, offset)
+            else:
+                # fill any gap before the data with zeroes
+                if offset > len(self.cache):
+                    self.cache.extend(bytes(offset - len(self.cache)))
+                self.cache[offset:end] = data
 
-            self.cache[offset:offset + len(data)] = data
             return len(data)
 
         def release(self):
+            with self.lock:
+                if self.spill is not None:
+                    self.spill.seek(0)
+                    contents = self.spill.read()
+                    self.spill.close()
+                else:
+                    contents = self.cache
+                self.cache = self.spill = None
+
+            try:
+                if self.encoding:
+                    contents = contents.decode(self.encoding)
+                else:
+                    contents = bytes(contents)
+                self.callback(contents)
+            except ValueError:
+                raise fuse.FuseOSError(errno.EIO)
+
+    class Stream:
+        def create(contents, encoding, **options):
+            if inspect.isgenerator(contents):
+                return FileWriter.Stream(contents, encoding)
+
+        def __init__(self, generator, encoding):
+            self.generator = generator
+            self.decoder = None
+            if encoding:
+                self.decoder = codecs.getincrementaldecoder(encoding)()
+
+            # data is sent in order, so data written ahead of the current
+            # position waits in a heap of (offset, data)
+            self.position = 0
+            self.pending = []
+            self.lock = threading.Lock()
+
+            # advance to the first yield, ready to be sent data
+            self._send(None)
+
+        def write(self, data, offset):
+            with self.lock:
+                return self._write(data, offset)
+
+        def release(self):
+            with self.lock:
+                self._release()
+
+        def _write(self, data, offset):
+            if self.generator is None:
+                raise fuse.FuseOSError(errno.EPIPE)
+            if offset < self.position:
+                # data has already been sent
+                raise fuse.FuseOSError(errno.ESPIPE)
+
+            heapq.heappush(self.pending, (offset, bytes(data)))
+            while self.pending and self.pending[0][0] <= self.position:
+                start, part = heapq.heappop(self.pending)
+                self._advance(part[self.position - start:])
+
+            return len(data)
+
+        def _release(self):
+            # send anything left over, filling any gaps with zeroes
+            while self.pending and self.generator is not None:
+                start, part = heapq.heappop(self.pending)
+                if start > self.position:
+                    self._advance(bytes(start - self.position))
+                self._advance(part[self.position - start:])
+
             try:
-                self.callback(bytes(self.cache).decode(self.encoding))
+                if self.decoder:
+                    data = self.decoder.decode(bytes(), final=True)
+                    if data:
+                        self._send(data)
             except ValueError:
                 raise fuse.FuseOSError(errno.EIO)
+            finally:
+                if self.generator is not None:
+                    self.generator.close()
+
+        def _advance(self, data):
+            if not data:
+                return
+            self.position += len(data)
+
+            if self.decoder:
+                try:
+                    data = self.decoder.decode(data)
+                except ValueError:
+                    raise fuse.FuseOSError(errno.EIO)
+            if data:
+                self._send(data)
+
+        def _send(self, data):
+            if self.generator is None:
+                return
+            try:
+                self.generator.send(data)
+            except StopIteration:
+                # the generator does not want any more data
+                self.generator = None
 
     class File:
-        def create(contents, encoding):
+        def create(contents, encoding, **options):
             if hasattr(contents, 'read') and hasattr(contents, 'write'):
                 return FileWriter.File(contents, encoding)
 
@@ -158,19 +628,64 @@ class FileWriter:
             self.file = file
             self.encoding = encoding
 
+            # byte files backed by a descriptor can be written directly, once
+            # anything already buffered has been written out
+            self.fd = None if encoding else _fileno(file)
+            if self.fd is not None:
+                self.file.flush()
+            self.lock = threading.Lock()
+
         def write(self, data, offset):
-            self.file.seek(offset)
+            if self.fd is not None:
+                return os.pwrite(self.fd, data, offset)
+
             if self.encoding:
                 data = data.decode(self.encoding)
-            return self.file.write(data)
+            with self.lock:
+                self.file.seek(offset)
+                return self.file.write(data)
 
         def release(self):
             self.file.close()
 
 
+class MemoryMap:
+    '''
+    Contents to be served from a read-only memory mapping of a file.
+
+    The file can be given as a path or as a file descriptor; a descriptor is
+    left open, and remains owned by the caller.
+    '''
+
+    def __init__(self, file):
+        self.file = file
+
+    def map(self):
+        if isinstance(self.file, int):
+            return self._map(self.file)
+
+        fd = os.open(self.file, os.O_RDONLY)
+        try:
+            return self._map(fd)
+        finally:
+            os.close(fd)
+
+    def _map(self, fd):
+        if os.fstat(fd).st_size == 0:
+            return None
+        return mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+
+
 class FileError(Exception):
     pass
 
 
 def _arg_count(func):
     return len(inspect.signature(func).parameters)
+
+
+def _fileno(file):
+    try:
+        return file.fileno()
+    except (AttributeError, OSError, ValueError):
+        return None
@@ -7,28 +7,140 @@ import errno
 from enum import Enum
 
 import time
+import ctypes
+import inspect
+import logging
 import itertools
 
+from concurrent import futures
+
+from . import cache
 from . import router
 from . import file
+from . import listing
+from . import loop
+from . import process
+from .metrics import Metrics
+
+log = logging.getLogger(__name__)
 
 
 class FileSystem(fuse.Operations):
-    def __init__(self):
-        self.routers = {method: router.Router() for method in Method}
+    def __init__(self, block_cache_size=64 * 1024 * 1024, processes=None,
+                 metrics=False):
+        self.router = router.Router(keys=Method)
         self.readers = {}
         self.writers = {}
+        self.directories = {}
 
-        self.fh = 0
+        # handles are allocated atomically, so are safe to use from threads
+        self.handles = itertools.count()
 
         self.timestamp = time.time()
+        self.templates = {}
+        self.attributes = cache.TTLCache()
+        self.listings = cache.TTLCache()
+        self.sizes = cache.TTLCache()
+        self.blocks = cache.BlockCache(block_cache_size)
+
+        self.loop = loop.EventLoop()
+        self.processes = process.ProcessPool(processes)
+        self.readahead = futures.ThreadPoolExecutor(
+            thread_name_prefix='mafs-readahead')
+
+        self.hooks = []
+        self.metrics = None
+        if metrics:
+            self.enable_metrics()
+
+    def __call__(self, op, *args):
+        hooks = self.hooks
+        if not hooks:
+            return super().__call__(op, *args)
+
+        path = args[0] if args else None
+        route = self._route(path, _CALLBACKS.get(op))
+
+        # hooks that fail are left out, rather than failing the operation
+        states = []
+        for hook in hooks:
+            try:
+                states.append(hook.before(op, path, route, args))
+            except Exception:
+                log.exception('hook %r failed before %s', hook, op)
+                states.append(_FAILED)
+
+        start = time.perf_counter()
+        try:
+            result = super().__call__(op, *args)
+        except BaseException as e:
+            self._after(hooks, states, op, path, route, start, error=e)
+            raise
+
+        if inspect.isgenerator(result):
+            # directory entries are produced as they are filled in
+            return self._after_entries(hooks, states, op, path, route,
+                                       start, result)
+
+        self._after(hooks, states, op, path, route, start, result)
+        return result
+
+    def add_hook(self, hook):
+        # hooks are replaced rather than changed, as they may be in use
+        self.hooks = self.hooks + [hook]
+
+    def enable_metrics(self):
+        if self.metrics is None:
+            self.metrics = Metrics()
+            self.add_hook(self.metrics)
+        return self.metrics
 
     # Filesystem methods
     # ==================
 
     def getattr(self, path, fi=None):
-        reader = self.routers[Method.READ].lookup(path)
-        writer = self.routers[Method.WRITE].lookup(path)
+        uid, gid, _ = fuse.fuse_get_context()
+
+        cached = self.attributes.get(path)
+        if cached and cached[:2] == (uid, gid):
+            attrs = cached[2]
+            if attrs is None:
+                raise fuse.FuseOSError(errno.ENOENT)
+            return attrs
+
+        match = self.router.resolve(path)
+        attrs = self._attributes(match, uid, gid)
+
+        sized = False
+        statter = match.get(Method.STAT)
+        if statter and statter.data:
+            callback, options = statter.data
+            ttl = options.get('ttl')
+
+            try:
+                contents = self._call(callback, path, statter.parameters)
+            except FileNotFoundError:
+                if ttl:
+                    self.attributes.set(path, (uid, gid, None), ttl)
+                raise fuse.FuseOSError(errno.ENOENT)
+
+            if isinstance(contents, os.stat_result):
+                contents = _stat_attrs(contents)
+            if contents:
+                attrs.update(contents)
+                sized = 'st_size' in contents
+
+            if ttl:
+                self.attributes.set(path, (uid, gid, attrs), ttl)
+
+        if not sized and stat.S_ISREG(attrs['st_mode']):
+            attrs['st_size'] = self._size(path, match)
+
+        return attrs
+
+    def _attributes(self, match, uid, gid):
+        reader = match.get(Method.READ)
+        writer = match.get(Method.WRITE)
 
         # FIXME: alert when reader and writer contradict each other
         if reader and reader.data or writer and writer.data:
@@ -42,7 +154,7 @@ class FileSystem(fuse.Operations):
             ftype = stat.S_IFDIR
             permissions = 0o755
         else:
-            link = self.routers[Method.READLINK].lookup(path)
+            link = match.get(Method.READLINK)
             if link and link.data:
                 ftype = stat.S_IFLNK
                 permissions = 0o755
@@ -50,129 +162,439 @@ class FileSystem(fuse.Operations):
                 # cannot find in router
                 raise fuse.FuseOSError(errno.ENOENT)
 
-        uid, gid, _ = fuse.fuse_get_context()
-        base = {
-            'st_atime': self.timestamp,
-            'st_ctime': self.timestamp,
-            'st_mtime': self.timestamp,
-
-            'st_gid': gid,
-            'st_uid': uid,
-
-            'st_mode': ftype | permissions,
-            'st_nlink': 1,
-            'st_size': 0
-        }
+        attrs = self._template(ftype | permissions).copy()
+        attrs['st_gid'] = gid
+        attrs['st_uid'] = uid
+        return attrs
 
-        statter = self.routers[Method.STAT].lookup(path)
-        if statter and statter.data:
-            try:
-                contents = statter.data(path, statter.parameters)
-            except FileNotFoundError:
-                raise fuse.FuseOSError(errno.ENOENT)
+    def opendir(self, path):
+        fh = next(self.handles)
+        self.directories[fh] = self._listing(path)
 
-            if contents:
-                return {**base, **contents}
+        return fh
 
-        return base
+    def readdir(self, path, fh, offset=0):
+        listing = self.directories.get(fh)
+        if listing is None:
+            listing = self._listing(path)
 
-    def readdir(self, path, fi):
-        dirs = set(['.', '..'])
+        # the caller, and the attributes of entries matching the same
+        # routes, are the same for the whole listing
+        uid, gid, _ = fuse.fuse_get_context()
+        templates = {}
+        prefix = path.rstrip('/') + '/'
 
-        ls = self.routers[Method.LIST].lookup(path)
-        if ls and ls.data:
-            contents = ls.data(path, ls.parameters)
-            return itertools.chain(dirs, contents)
-        else:
-            for method in (Method.READ, Method.WRITE, Method.READLINK):
-                contents = self.routers[method].list(path)
-                if contents and contents.data:
-                    return itertools.chain(dirs, contents.data)
+        for name, attrs, offset in listing.read(offset):
+            if attrs:
+                attrs = self._preload(prefix + name, attrs, listing.ttl,
+                                      uid, gid, templates)
+            yield (name, attrs, offset)
 
-        return dirs
+    def releasedir(self, path, fh):
+        listing = self.directories.pop(fh, None)
+        if listing:
+            listing.release()
 
     def readlink(self, path):
-        result = self.routers[Method.READLINK].lookup(path)
+        result = self.router.lookup(path, Method.READLINK)
         if result:
-            return result.data(path, result.parameters)
+            return self._call(result.data, path, result.parameters)
 
     def truncate(self, path, length, fi=None):
         pass
 
+    def init(self, path):
+        # called once mounted (and daemonized), before FUSE serves anything
+        self.start_processes()
+
+    def start_processes(self):
+        # worker processes are forked before any other threads are started
+        if self.processes.required:
+            self.processes.start()
+
+    def destroy(self, path):
+        for hook in self.hooks:
+            hook.close()
+
+        self.loop.stop()
+        self.processes.stop()
+        self.readahead.shutdown(wait=False)
+
     # File methods
     # ============
 
     def open(self, path, fi):
-        reader = self.routers[Method.READ].lookup(path)
-        writer = self.routers[Method.WRITE].lookup(path)
+        match = self.router.resolve(path)
+        reader = match.get(Method.READ)
+        writer = match.get(Method.WRITE)
 
+        fh = next(self.handles)
         success = False
+        direct_io = True
+        keep_cache = False
 
         if fi.flags & os.O_RDONLY == os.O_RDONLY and reader and reader.data:
-            callback, encoding = reader.data
-            contents = callback(path, reader.parameters)
-
-            if contents:
-                r = file.FileReader.create(contents, encoding)
-                self.readers[self.fh] = r
+            callback, encoding, options = reader.data
+
+            direct_io = options.get('direct_io', True)
+            keep_cache = options.get('keep_cache', False)
+
+            def create():
+                if options.get('process'):
+                    r = self.processes.read(callback, path,
+                                            reader.parameters, encoding)
+                else:
+                    contents = self._call(callback, path, reader.parameters)
+                    if not contents:
+                        return None
+                    r = file.FileReader.create(contents, encoding,
+                                               **options)
+
+                # the size of the contents may have changed since last opened
+                size = r.size() or False
+                if self.sizes.get(path, size) != size:
+                    self.attributes.invalidate(path)
+                self.sizes.set(path, size)
+
+                # readers producing data on demand are read ahead of
+                # sequential reads
+                window = options.get('readahead')
+                if window and isinstance(r, (file.FileReader.Function,
+                                             file.FileReader.Iterable)):
+                    r = file.FileReader.Readahead(r, self.readahead, window)
+                return r
+
+            if options.get('block_cache'):
+                r = file.FileReader.Cached(create, self.blocks, path)
+            else:
+                r = create()
+            if r:
+                self.readers[fh] = r
 
             success = True
 
         if fi.flags & os.O_WRONLY == os.O_WRONLY and writer and writer.data:
-            callback, encoding = writer.data
-            contents = callback(path, writer.parameters)
+            callback, encoding, options = writer.data
+            contents = self._call(callback, path, writer.parameters,
+                                  sink=True)
 
             if contents:
-                w = file.FileWriter.create(contents, encoding)
-                self.writers[self.fh] = w
+                w = file.FileWriter.create(contents, encoding, **options)
+                self.writers[fh] = w
 
             success = True
 
         if success:
-            fi.fh = self.fh
-            self.fh += 1
-            fi.direct_io = True
+            fi.fh = fh
+            fi.direct_io = direct_io
+            fi.keep_cache = keep_cache
 
             return 0
         else:
             return -1
 
     def read(self, path, length, offset, fi):
-        if fi.fh in self.readers:
-            return self.readers[fi.fh].read(length, offset)
+        reader = self.readers.get(fi.fh)
+        if reader:
+            data = reader.read(length, offset)
+            if isinstance(data, memoryview):
+                data = _fuse_buffer(data)
+            return data
 
     def write(self, path, data, offset, fi):
-        if fi.fh in self.writers:
-            return self.writers[fi.fh].write(data, offset)
+        writer = self.writers.get(fi.fh)
+        if writer:
+            return writer.write(data, offset)
         else:
             return len(data)
 
     def release(self, path, fi):
-        if fi.fh in self.readers:
-            reader = self.readers.pop(fi.fh)
+        reader = self.readers.pop(fi.fh, None)
+        if reader:
             reader.release()
 
-        if fi.fh in self.writers:
-            writer = self.writers.pop(fi.fh)
+        writer = self.writers.pop(fi.fh, None)
+        if writer:
             writer.release()
 
+            # the write may have changed the file's attributes
+            self.invalidate(path)
+
+    def _call(self, callback, path, parameters, sink=False):
+        # asynchronous callbacks, and any asynchronous contents they return,
+        # are run on the event loop
+        contents = callback(path, parameters)
+        if inspect.isawaitable(contents):
+            contents = self.loop.run(contents)
+
+        if inspect.iscoroutinefunction(contents):
+            contents = self.loop.wrap(contents)
+        elif sink and inspect.isasyncgen(contents):
+            contents = self.loop.sink(contents)
+        elif hasattr(contents, '__aiter__'):
+            contents = self.loop.iterate(contents)
+
+        return contents
+
+    # Caching
+    # =======
+
+    def invalidate(self, path=None):
+        if path is None:
+            self.attributes.clear()
+            self.listings.clear()
+            self.sizes.clear()
+            self.blocks.invalidate()
+        else:
+            self.attributes.invalidate(path)
+            self.sizes.invalidate(path)
+            self.blocks.invalidate(path)
+            self.listings.invalidate(path)
+            self.listings.invalidate(os.path.dirname(path))
+
+    def _listing(self, path):
+        cached = self.listings.get(path)
+        if cached is not None:
+            names, attr_ttl = cached
+            return listing.Listing(lambda: names, attr_ttl)
+
+        ls = self.router.lookup(path, Method.LIST)
+        if ls and ls.data:
+            callback, options = ls.data
+            ttl = options.get('ttl')
+
+            def generate():
+                return self._call(callback, path, ls.parameters)
+
+            if not ttl:
+                return listing.Listing(generate, options.get('attr_ttl', 1))
+            names = tuple(generate() or ())
+        else:
+            # directories made only of routes can be listed from the router
+            names = {}
+            for method in (Method.READ, Method.WRITE, Method.READLINK):
+                contents = self.router.list(path, method)
+                if contents and contents.data:
+                    names.update(dict.fromkeys(contents.data))
+            names = tuple(names)
+            ttl = None
+            options = {}
+
+        attr_ttl = options.get('attr_ttl', 1)
+        self.listings.set(path, (names, attr_ttl), ttl)
+        return listing.Listing(lambda: names, attr_ttl)
+
+    def _size(self, path, match):
+        # contents with a known length are sized by creating a reader for
+        # them, and the size kept until the file is written to or reopened
+        size = self.sizes.get(path)
+        if size is not None:
+            return size or 0
+
+        size = False
+        reader = match.get(Method.READ)
+        if reader and reader.data:
+            callback, encoding, options = reader.data
+
+            # contents produced by other processes, or only once blocks are
+            # missing from the cache, are sized once they are opened
+            if not options.get('process') and not options.get('block_cache'):
+                try:
+                    size = self._probe(path, reader, callback, encoding,
+                                       options)
+                except Exception:
+                    # files that cannot be read still exist, and fail to
+                    # open instead
+                    pass
+
+        self.sizes.set(path, size)
+        return size or 0
+
+    def _probe(self, path, reader, callback, encoding, options):
+        contents = self._call(callback, path, reader.parameters)
+        if not contents:
+            return False
+
+        r = file.FileReader.create(contents, encoding, **options)
+        try:
+            return r.size() or False
+        finally:
+            r.release()
+
+    def _route(self, path, key):
+        # operations are attributed to the route of the callback they use,
+        # or failing that, to whichever route matched
+        if path is None:
+            return None
+
+        match = self.router.resolve(path)
+        results = [match.get(key)] + list(match.values())
+        for result in results:
+            if result is not None and result.data is not None:
+                return result.route
+        for result in results:
+            if result is not None:
+                return result.route
+        return None
+
+    def _after(self, hooks, states, op, path, route, start, result=None,
+               error=None):
+        duration = time.perf_counter() - start
+        for hook, state in zip(reversed(hooks), reversed(states)):
+            if state is _FAILED:
+                continue
+            try:
+                hook.after(op, path, route, state, duration, result, error)
+            except Exception:
+                log.exception('hook %r failed after %s', hook, op)
+
+    def _after_entries(self, hooks, states, op, path, route, start, entries):
+        error = None
+        try:
+            yield from entries
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self._after(hooks, states, op, path, route, start, None, error)
+
+    def _preload(self, path, contents, ttl, uid, gid, templates):
+        # attributes given in a listing are used for later stat requests
+        match = self.router.resolve(path)
+        routes = tuple([result.route for result in match.values()])
+
+        template = templates.get(routes)
+        if template is None:
+            try:
+                template = self._attributes(match, uid, gid)
+            except fuse.FuseOSError:
+                template = False
+            templates[routes] = template
+        if not template:
+            return None
+        attrs = template.copy()
+
+        if isinstance(contents, os.stat_result):
+            contents = _stat_attrs(contents)
+        attrs.update(contents)
+
+        self.attributes.set(path, (uid, gid, attrs), ttl)
+        return attrs
+
+    def _template(self, mode):
+        template = self.templates.get(mode)
+        if template is None:
+            template = self.templates[mode] = {
+                'st_atime': self.timestamp,
+                'st_ctime': self.timestamp,
+                'st_mtime': self.timestamp,
+
+                'st_mode': mode,
+                'st_nlink': 1,
+                'st_size': 0
+            }
+        return template
+
     # Callbacks
     # =========
 
-    def onstat(self, path, callback):
-        self.routers[Method.STAT].add(path, callback)
+    def onstat(self, path, callback, **options):
+        self.router.add(path, (callback, options), Method.STAT)
+        self.invalidate()
 
-    def onread(self, path, callback, encoding='utf-8'):
-        self.routers[Method.READ].add(path, (callback, encoding))
+    def onread(self, path, callback, encoding='utf-8', **options):
+        self.router.add(path, (callback, encoding, options), Method.READ)
+        if options.get('process'):
+            self.processes.required = True
+        self.invalidate()
 
-    def onwrite(self, path, callback, encoding='utf-8'):
-        self.routers[Method.WRITE].add(path, (callback, encoding))
+    def onwrite(self, path, callback, encoding='utf-8', **options):
+        self.router.add(path, (callback, encoding, options), Method.WRITE)
+        self.invalidate()
 
     def onreadlink(self, path, callback):
-        self.routers[Method.READLINK].add(path, callback)
+        self.router.add(path, callback, Method.READLINK)
+        self.invalidate()
+
+    def onlist(self, path, callback, **options):
+        self.router.add(path, (callback, options), Method.LIST)
+        self.invalidate()
+
+    def onmanifest(self, path, manifest, callback=None, encoding='utf-8',
+                   **options):
+        # the whole manifest is served by a single route, with callbacks
+        # shared between all of its files
+        def lookup(ps):
+            name = '/'.join(getattr(ps, 'path', ()))
+            value = manifest.get(name, _DIRECTORY)
+
+            # the root is a directory even when the manifest is empty
+            if value is _DIRECTORY and name and not manifest.isdir(name):
+                raise fuse.FuseOSError(errno.ENOENT)
+            return name, value
+
+        def size(value):
+            if isinstance(value, int):
+                return value
+            if isinstance(getattr(value, 'size', None), int):
+                return value.size
+            if isinstance(value, str):
+                return len(value.encode(encoding or 'utf-8'))
+            if value is not None:
+                return len(value)
+            return 0
+
+        def attributes(value):
+            if value is _DIRECTORY:
+                return {'st_mode': stat.S_IFDIR | 0o755}
+            return {'st_size': size(value)}
+
+        def statter(path, ps):
+            _, value = lookup(ps)
+            return attributes(value)
+
+        def lister(path, ps):
+            name, _ = lookup(ps)
+            for entry, value, directory in manifest.list(name):
+                yield entry, attributes(_DIRECTORY if directory else value)
+
+        def reader(path, ps):
+            _, value = lookup(ps)
+            if value is _DIRECTORY:
+                raise fuse.FuseOSError(errno.EISDIR)
+            if callback:
+                return callback(path, ps)
+            if not isinstance(value, int):
+                return value
+
+        route = path.rstrip('/') + '/*path'
+        self.router.add(path, (lister, {}), Method.LIST)
+        self.router.add(route, (lister, {}), Method.LIST)
+        self.router.add(route, (statter, {}), Method.STAT)
+        self.router.add(route, (reader, encoding, options), Method.READ)
+        self.invalidate()
+
+
+class FUSE(fuse.FUSE):
+    '''
+    FUSE bindings that also pass the offset to the readdir operation, so that
+    large directories can be read in parts.
+    '''
+
+    def readdir(self, path, buf, filler, offset, fip):
+        entries = self.operations('readdir', self._decode_optional_path(path),
+                                  fip.contents.fh, offset)
+
+        for name, attrs, offset in entries:
+            st = None
+            if attrs:
+                st = fuse.c_stat()
+                fuse.set_st_attrs(st, attrs, use_ns=self.use_ns)
 
-    def onlist(self, path, callback):
-        self.routers[Method.LIST].add(path, callback)
+            if filler(buf, name.encode(self.encoding), st, offset) != 0:
+                break
+
+        return 0
 
 
 class Method(Enum):
@@ -181,3 +603,80 @@ class Method(Enum):
     WRITE = 2
     READLINK = 3
     LIST = 4
+
+
+# the callbacks used by each operation, for finding the route it uses
+_CALLBACKS = {
+    'getattr': Method.STAT,
+    'opendir': Method.LIST,
+    'readdir': Method.LIST,
+    'releasedir': Method.LIST,
+    'open': Method.READ,
+    'read': Method.READ,
+    'write': Method.WRITE,
+    'truncate': Method.WRITE,
+    'release': Method.READ,
+    'readlink': Method.READLINK,
+}
+
+
+# the value given to directories in a manifest
+_DIRECTORY = object()
+
+# the state of a hook that failed before an operation
+_FAILED = object()
+
+
+def _stat_attrs(result):
+    return {key: getattr(result, key) for key in _STAT_KEYS}
+
+
+_STAT_KEYS = ('st_mode', 'st_ino', 'st_dev', 'st_nlink', 'st_uid', 'st_gid',
+              'st_size', 'st_atime', 'st_mtime', 'st_ctime')
+
+
+def _fuse_buffer(view):
+    # fuse copies from the returned data using a pointer, which is taken
+    # directly from the buffer rather than copying it first
+    if not view.readonly:
+        return (ctypes.c_char * view.nbytes).from_buffer(view)
+    if isinstance(view.obj, bytes) and view.nbytes == len(view.obj):
+        return view.obj
+    if not view.nbytes:
+        return bytes()
+
+    # read-only buffers cannot be used by from_buffer, so are used by their
+    # address, with the view kept alive for as long as the array
+    data = (ctypes.c_char * view.nbytes).from_address(_address(view))
+    data.view = view
+    return data
+
+
+class _Buffer(ctypes.Structure):
+    # a Py_buffer, as filled in by the buffer protocol
+    _fields_ = [('buf', ctypes.c_void_p), ('obj', ctypes.c_void_p),
+                ('len', ctypes.c_ssize_t), ('itemsize', ctypes.c_ssize_t),
+                ('readonly', ctypes.c_int), ('ndim', ctypes.c_int),
+                ('format', ctypes.c_char_p), ('shape', ctypes.c_void_p),
+                ('strides', ctypes.c_void_p),
+                ('suboffsets', ctypes.c_void_p),
+                ('internal', ctypes.c_void_p)]
+
+
+_get_buffer = ctypes.pythonapi.PyObject_GetBuffer
+_get_buffer.argtypes = (ctypes.py_object, ctypes.POINTER(_Buffer),
+                        ctypes.c_int)
+_get_buffer.restype = ctypes.c_int
+
+_release_buffer = ctypes.pythonapi.PyBuffer_Release
+_release_buffer.argtypes = (ctypes.POINTER(_Buffer),)
+_release_buffer.restype = None
+
+
+def _address(view):
+    buffer = _Buffer()
+    _get_buffer(view, ctypes.byref(buffer), 0)
+    try:
+        return buffer.buf
+    finally:
+        _release_buffer(ctypes.byref(buffer))
@@ -0,0 +1,194 @@
+import io
+import os
+import random
+import pstats
+import cProfile
+import threading
+import tracemalloc
+
+from urllib.parse import quote
+
+
+class Hook:
+    '''
+    A hook called around every filesystem operation.
+
+    before() is called with the operation name, the path, the matched route
+    pattern (None if no route matched) and all the arguments of the
+    operation, and returns some state. Once the operation has finished,
+    after() is called with the operation, path and route, that state, the
+    duration of the operation in seconds, and either its result or the
+    exception it raised.
+    '''
+
+    def before(self, op, path, route, args):
+        return None
+
+    def after(self, op, path, route, state, duration, result=None,
+              error=None):
+        pass
+
+    def close(self):
+        pass
+
+
+class Profiler(Hook):
+    '''
+    A hook that profiles operations with cProfile, separately for each
+    route.
+
+    Only the given fraction (rate) of operations are profiled. Only one
+    profiler can be active in a process at a time, so operations that start
+    while another is being profiled (in another thread, or by anything else
+    in the process) are not profiled. Profiles are written to directory, one
+    file per route, by dump(), and when the filesystem is unmounted.
+    '''
+
+    def __init__(self, directory=None, rate=1.0):
+        self.directory = directory
+        self.rate = rate
+
+        self.profiles = {}
+        self._lock = threading.Lock()
+
+    def before(self, op, path, route, args):
+        if self.rate < 1 and random.random() >= self.rate:
+            return None
+        if not _PROFILING.acquire(blocking=False):
+            return None
+
+        with self._lock:
+            profile = self.profiles.get(route)
+            if profile is None:
+                profile = self.profiles[route] = cProfile.Profile()
+
+        try:
+            profile.enable()
+        except ValueError:
+            # another profiler outside of mafs is active
+            _PROFILING.release()
+            return None
+        return profile
+
+    def after(self, op, path, route, state, duration, result=None,
+              error=None):
+        if state is not None:
+            state.disable()
+            _PROFILING.release()
+
+    def close(self):
+        if self.directory:
+            self.dump()
+
+    def stats(self):
+        '''
+        Get the collected profiles, as a mapping of routes to pstats.Stats.
+        '''
+
+        with self._lock:
+            profiles = list(self.profiles.items())
+
+        stats = {}
+        for route, profile in profiles:
+            try:
+                stats[route] = pstats.Stats(profile)
+            except TypeError:
+                # nothing has been profiled yet
+                pass
+        return stats
+
+    def dump(self, directory=None):
+        '''
+        Write the collected profiles to a directory, as a file for each route
+        that can be loaded with pstats.
+        '''
+
+        directory = directory or self.directory
+        os.makedirs(directory, exist_ok=True)
+
+        for route, stats in self.stats().items():
+            name = quote(route, safe='') if route else 'unmatched'
+            stats.dump_stats(os.path.join(directory, name + '.prof'))
+
+    def report(self, limit=20):
+        '''
+        Summarise the collected profiles as text, listing the functions with
+        the most cumulative time for each route.
+        '''
+
+        output = io.StringIO()
+        for route, stats in sorted(self.stats().items(),
+                                   key=lambda item: item[0] or ''):
+            output.write('route: {}\n'.format(route))
+            stats.stream = output
+            stats.sort_stats('cumulative').print_stats(limit)
+        return output.getvalue()
+
+
+class AllocationTracer(Hook):
+    '''
+    A hook that accounts for memory allocated during operations using
+    tracemalloc, separately for each route.
+
+    Allocations are measured as the change in traced memory over each
+    operation, so when operations run at the same time in several threads,
+    each may be counted against the others.
+    '''
+
+    def __init__(self, frames=1):
+        self.routes = {}
+        self._lock = threading.Lock()
+
+        self.started = not tracemalloc.is_tracing()
+        if self.started:
+            tracemalloc.start(frames)
+
+    def before(self, op, path, route, args):
+        return tracemalloc.get_traced_memory()[0]
+
+    def after(self, op, path, route, state, duration, result=None,
+              error=None):
+        allocated = tracemalloc.get_traced_memory()[0] - state
+
+        with self._lock:
+            stats = self.routes.get(route)
+            if stats is None:
+                stats = self.routes[route] = {'count': 0, 'allocated': 0,
+                                              'largest': 0}
+            stats['count'] += 1
+            stats['allocated'] += allocated
+            stats['largest'] = max(stats['largest'], allocated)
+
+    def close(self):
+        if self.started and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    def report(self, limit=10):
+        '''
+        Summarise the memory allocated for each route, followed by the
+        places that currently have the most memory allocated.
+        '''
+
+        with self._lock:
+            routes = [(route, dict(stats))
+                      for route, stats in self.routes.items()]
+
+        lines = []
+        for route, stats in sorted(routes, key=lambda item: item[0] or ''):
+            lines.append('{}: {} operations, {} bytes retained, '
+                         'at most {} bytes in one operation'.format(
+                             route, stats['count'], stats['allocated'],
+                             stats['largest']))
+
+        if tracemalloc.is_tracing():
+            lines.append('')
+            snapshot = tracemalloc.take_snapshot()
+            for statistic in snapshot.statistics('lineno')[:limit]:
+                lines.append(str(statistic))
+
+        return '\n'.join(lines) + '\n'
+
+
+# operations are profiled one at a time, since only one profiler can be
+# active in a process at once
+_PROFILING = threading.Lock()
@@ -0,0 +1,66 @@
+import itertools
+
+from collections import deque
+
+
+class Listing:
+    '''
+    The entries of an open directory, read from a given offset.
+
+    Entries are pulled lazily from the iterable produced by generate, and
+    only those that have not yet been read are kept, so that reading can
+    resume from the last offset without producing the listing again. Reading
+    from an earlier offset starts again from the beginning.
+
+    The iterable can produce names, or (name, attrs) pairs. Each entry is
+    read as a (name, attrs, offset) tuple, where offset is the offset of the
+    entry following it, and ttl is how long any attrs remain valid for.
+    '''
+
+    def __init__(self, generate, ttl=None):
+        self.generate = generate
+        self.ttl = ttl
+        self._restart()
+
+    def read(self, offset=0):
+        if offset < self.start:
+            self._restart()
+
+        # discard entries before the offset, which have already been read
+        while self.start < offset:
+            if self.buffer:
+                self.buffer.popleft()
+            elif next(self.entries, _END) is _END:
+                return
+            self.start += 1
+
+        position = self.start
+        for name, attrs in tuple(self.buffer):
+            position += 1
+            yield (name, attrs, position)
+
+        for entry in self.entries:
+            if isinstance(entry, str):
+                name, attrs = entry, None
+            else:
+                name, attrs = entry
+
+            self.buffer.append((name, attrs))
+            position += 1
+            yield (name, attrs, position)
+
+    def release(self):
+        if hasattr(self.contents, 'close'):
+            self.contents.close()
+
+    def _restart(self):
+        self.contents = self.generate()
+        if self.contents is None:
+            self.contents = []
+
+        self.entries = itertools.chain(['.', '..'], self.contents)
+        self.buffer = deque()
+        self.start = 0
+
+
+_END = object()
@@ -0,0 +1,73 @@
+import asyncio
+import functools
+import threading
+
+
+class EventLoop:
+    '''
+    A long-lived asyncio event loop, running in its own thread.
+
+    Coroutines are submitted from other threads, which wait for their
+    results, so that many slow operations can be in progress at once. The
+    loop is only started once it is first needed.
+    '''
+
+    def __init__(self):
+        self.loop = None
+        self.thread = None
+
+        self._lock = threading.Lock()
+
+    def run(self, coroutine):
+        future = asyncio.run_coroutine_threadsafe(coroutine, self._start())
+        return future.result()
+
+    def wrap(self, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            return self.run(func(*args, **kwargs))
+        return wrapper
+
+    def iterate(self, iterable):
+        iterator = iterable.__aiter__()
+        try:
+            while True:
+                try:
+                    yield self.run(iterator.__anext__())
+                except StopAsyncIteration:
+                    return
+        finally:
+            if hasattr(iterator, 'aclose'):
+                self.run(iterator.aclose())
+
+    def sink(self, generator):
+        try:
+            self.run(generator.asend(None))
+            while True:
+                self.run(generator.asend((yield)))
+        except StopAsyncIteration:
+            return
+        finally:
+            self.run(generator.aclose())
+
+    def stop(self):
+        with self._lock:
+            if self.loop is None:
+                return
+
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+            self.loop.close()
+
+            self.loop = None
+            self.thread = None
+
+    def _start(self):
+        with self._lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                self.thread = threading.Thread(target=self.loop.run_forever,
+                                               name='mafs-loop', daemon=True)
+                self.thread.start()
+
+            return self.loop
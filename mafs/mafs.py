@@ -1,9 +1,13 @@
-import fuse
 import stat
 
 import argparse
 
+from .file import FileWriter
 from . import filesystem
+from .manifest import Manifest
+from .archive import open_archive
+from .hooks import Profiler, AllocationTracer
+from . import trace as tracing
 
 
 class MagicFS:
@@ -30,21 +34,51 @@ class MagicFS:
     Functions provided as callbacks should return different data types
     depending on what kind of action they perform. For specific details, see
     the documentatation for each callback register.
+
+    Any callback may be asynchronous (an async def function), and may return
+    asynchronous versions of its usual contents: async generators in place
+    of generators, async iterables in place of iterables, and async
+    functions in place of functions. These are all run on a single event
+    loop in a background thread, so that with threads enabled, many slow
+    operations can be in progress at once.
     '''
 
-    def __init__(self):
-        self.fs = filesystem.FileSystem()
+    def __init__(self, block_cache_size=64 * 1024 * 1024, processes=None,
+                 metrics=False):
+        self.fs = filesystem.FileSystem(block_cache_size, processes, metrics)
 
         self._user_args = []
         self._args = None
 
-    def mount(self, mountpoint, foreground=False, threads=False):
+    def mount(self, mountpoint, foreground=False, threads=False,
+              attr_timeout=None, entry_timeout=None, kernel_cache=False):
         '''
         Mount the filesystem.
+
+        The kernel caches file attributes for attr_timeout seconds, and the
+        results of looking up names for entry_timeout seconds; if they are
+        None, the FUSE defaults are used. If kernel_cache is set, the kernel
+        keeps the contents of files in its page cache between opens for all
+        routes that do not use direct_io.
         '''
 
-        fuse.FUSE(self.fs, mountpoint, raw_fi=True, nothreads=not threads,
-                  foreground=foreground, default_permissions=True)
+        options = {}
+        if attr_timeout is not None:
+            options['attr_timeout'] = attr_timeout
+        if entry_timeout is not None:
+            options['entry_timeout'] = entry_timeout
+        if kernel_cache:
+            options['kernel_cache'] = True
+
+        # worker processes must be forked before FUSE starts its threads;
+        # in the background, FUSE forks again to daemonize, so they are then
+        # started once it has been mounted instead
+        if foreground:
+            self.fs.start_processes()
+
+        filesystem.FUSE(self.fs, mountpoint, raw_fi=True,
+                        nothreads=not threads, foreground=foreground,
+                        default_permissions=True, **options)
 
     def run(self):
         '''
@@ -52,7 +86,21 @@ class MagicFS:
         '''
 
         args = self.args
-        self.mount(args.mountpoint, args.foreground, args.threads)
+        if args.trace:
+            self.trace(args.trace)
+        if args.stats:
+            self.stats(args.stats)
+        if args.profile:
+            self.profile(args.profile, rate=args.profile_rate)
+        if args.trace_allocations:
+            self.trace_allocations()
+
+        if args.replay:
+            self.replay(args.replay, args.replay_speed, args.replay_threads)
+            return
+
+        self.mount(args.mountpoint, args.foreground, args.threads,
+                   args.attr_timeout, args.entry_timeout, args.kernel_cache)
 
     def add_argument(self, *args, **kwargs):
         '''
@@ -67,39 +115,235 @@ class MagicFS:
     def args(self):
         if not self._args:
             parser = argparse.ArgumentParser()
-            parser.add_argument('mountpoint',
+            parser.add_argument('mountpoint', nargs='?',
                                 help='folder to mount the filesystem in')
             parser.add_argument('-fg', '--foreground', action='store_true',
                                 help='run in the foreground')
             parser.add_argument('-t', '--threads', action='store_true',
                                 help='allow the use of threads')
+            parser.add_argument('--attr-timeout', type=float,
+                                help='seconds to cache file attributes for')
+            parser.add_argument('--entry-timeout', type=float,
+                                help='seconds to cache name lookups for')
+            parser.add_argument('--kernel-cache', action='store_true',
+                                help='keep file contents cached between opens')
+            parser.add_argument('--stats', nargs='?', const='/.mafs/stats',
+                                help='serve operation metrics as a file')
+            parser.add_argument('--profile', metavar='DIRECTORY',
+                                help='profile callbacks for each route')
+            parser.add_argument('--profile-rate', type=float, default=1.0,
+                                help='fraction of operations to profile')
+            parser.add_argument('--trace-allocations', action='store_true',
+                                help='account for memory used by each route')
+            parser.add_argument('--trace', metavar='FILE',
+                                help='record operations to a trace file')
+            parser.add_argument('--replay', metavar='FILE',
+                                help='replay a trace instead of mounting')
+            parser.add_argument('--replay-speed', type=float, default=1.0,
+                                help='speed up replays (0 for full speed)')
+            parser.add_argument('--replay-threads', type=int, default=1,
+                                help='threads to replay operations with')
 
             for (args, kwargs) in self._user_args:
                 parser.add_argument(*args, **kwargs)
 
             self._args = parser.parse_args()
+            if not self._args.mountpoint and not self._args.replay:
+                parser.error('the mountpoint is required')
 
         return self._args
 
+    def invalidate(self, path=None):
+        '''
+        Discard cached information about a path, or about every path if no
+        path is given.
+        '''
+
+        self.fs.invalidate(path)
+
+    @property
+    def metrics(self):
+        '''
+        The metrics collected about filesystem operations, or None if they
+        are not enabled.
+
+        Metrics are kept for each operation and matched route, and can be
+        retrieved using metrics.snapshot(), or rendered in the Prometheus
+        text format using metrics.render().
+        '''
+
+        return self.fs.metrics
+
+    def stats(self, route='/.mafs/stats'):
+        '''
+        Serve the metrics of filesystem operations as a file at route, in the
+        Prometheus text format, enabling metrics if they are not already.
+        '''
+
+        metrics = self.fs.enable_metrics()
+        self.onread(route, lambda path, ps: metrics.render())
+
+    def trace(self, path):
+        '''
+        Record every operation to a trace file at path, which can later be
+        replayed using replay().
+        '''
+
+        recorder = tracing.Recorder(path)
+        self.fs.add_hook(recorder)
+        return recorder
+
+    def replay(self, path, speed=1.0, threads=1):
+        '''
+        Replay a trace file against this filesystem without mounting it, and
+        print a summary of the operations replayed to stdout, along with
+        their metrics.
+
+        Operations are replayed at their recorded times sped up by speed,
+        or as fast as possible if speed=0, using the given number of threads.
+        Data that was read or written is not recorded, so writes are
+        replayed with zeroes.
+        '''
+
+        metrics = self.fs.enable_metrics()
+
+        self.fs.start_processes()
+        summary = tracing.replay(self.fs, tracing.read(path), speed, threads)
+        self.fs('destroy', '/')
+
+        print('replayed {operations} operations in {seconds:.3f} seconds, '
+              '{errors} failed'.format(**summary))
+        print(metrics.render(), end='')
+        return summary
+
+    def hook(self, hook):
+        '''
+        Add a hook to be called around every filesystem operation.
+
+        The hook should have the methods of mafs.Hook: before(op, path,
+        route, args), which returns some state, and after(op, path, route,
+        state, duration, result, error), called once the operation has
+        finished.
+        Hooks are only called if there are any, so cost nothing otherwise.
+        Exceptions raised by hooks are logged, and do not fail operations.
+        '''
+
+        self.fs.add_hook(hook)
+
+    def profile(self, directory, route='/.mafs/profile', rate=1.0):
+        '''
+        Profile operations with cProfile, separately for each route.
+
+        Only the given fraction (rate) of operations is profiled, and only
+        one operation at a time, as only one profiler can be active in a
+        process; operations that start while another is being profiled are
+        skipped. Reading the file at route writes the profiles collected so
+        far to directory (as a file for each route, to be loaded with
+        pstats), and gives a summary of them; they are also written when the
+        filesystem is unmounted.
+        '''
+
+        profiler = Profiler(directory, rate)
+        self.fs.add_hook(profiler)
+
+        # profiles are only dumped once read, not when sized by stat
+        def report(path, ps):
+            profiler.dump()
+            yield profiler.report()
+        self.onread(route, report)
+
+        return profiler
+
+    def trace_allocations(self, route='/.mafs/allocations', frames=1):
+        '''
+        Account for the memory allocated by operations using tracemalloc,
+        separately for each route.
+
+        Reading the file at route gives the memory allocated for each route,
+        and the places with the most memory currently allocated (with
+        tracebacks of the given number of frames).
+        '''
+
+        tracer = AllocationTracer(frames)
+        self.fs.add_hook(tracer)
+        self.onread(route, lambda path, ps: tracer.report())
+
+        return tracer
+
     # Callbacks
     # =========
 
-    def onread(self, route, func, encoding='utf-8'):
+    def onread(self, route, func, encoding='utf-8', sequential=False,
+               direct_io=True, keep_cache=False, block_cache=False,
+               process=False, readahead=0):
         '''
         Register a callback for read requests.
 
         The callback can return:
             - None
             - a string
+            - a bytes-like object (such as bytes, bytearray, memoryview or
+              array), which is served without encoding, and read by FUSE
+              directly without copying each read; a bytearray or array is
+              copied once when the file is opened, so that it can still be
+              resized while the file is open
             - an iterable (or generator)
             - a readable file object
+            - a memory mapping (an mmap.mmap, or a MemoryMap of a path or
+              file descriptor)
             - a function taking two parameters, length and offset, and
               returning a byte string
+
+        If sequential is set, data produced by an iterable is discarded once
+        it has been read, so that large generated files can be streamed from
+        start to end in bounded memory. Reads behind previously read data
+        will then fail.
+
+        The size of a file is found from its contents when they have a known
+        length (a string, bytes-like object, memory mapping or file with a
+        descriptor), by calling the callback when the file is first stat-ed.
+        If the callback fails, the size is reported as 0, and the file fails
+        to open instead. Files using process or block_cache are not sized
+        until they are opened, to avoid producing their contents twice.
+        Sizes are kept until the file is written to or reopened, or
+        invalidate() is called; a stat callback can give the size instead.
+
+        By default, reads bypass the kernel page cache (direct_io), so that
+        callbacks see every read. For content that can be cached, set
+        direct_io=False; the file's size must then be known, either from its
+        contents or from a stat callback. If keep_cache is also set, cached
+        content is kept between opens of the file.
+
+        If block_cache is set, file contents are cached in blocks shared
+        between all opens of the file, and the callback is only called (when
+        the file is read) if a block is not cached. The cache is limited to
+        the block_cache_size given to MagicFS, and cached blocks for a path
+        are discarded when it is written to or invalidate() is called.
+
+        If process is set, the callback is run in a pool of worker processes
+        (of the size given to MagicFS, by default one per CPU), and its
+        contents are produced in full there and returned through shared
+        memory. This allows CPU heavy callbacks to run in parallel. The
+        callback must be a module level function, as it is pickled. The
+        workers are forked when the filesystem is mounted, so should be
+        registered before then.
+
+        If readahead is set, when an iterable or function is read
+        sequentially, up to readahead bytes following the last read are
+        produced in the background, so that later reads do not have to
+        wait for them. This helps slow sources, such as remote ones, while
+        fast sources are better read as they are. The iterable or function
+        is then called from a background thread, even if threads are not
+        enabled. A readahead of around a megabyte works well.
         '''
 
-        self.fs.onread(route, func, encoding)
+        self.fs.onread(route, func, encoding, sequential=sequential,
+                       direct_io=direct_io, keep_cache=keep_cache,
+                       block_cache=block_cache, process=process,
+                       readahead=readahead)
 
-    def onwrite(self, route, func, encoding):
+    def onwrite(self, route, func, encoding,
+                spill_size=FileWriter.Full.SPILL_SIZE):
         '''
         Register a callback for write requests.
 
@@ -108,21 +352,42 @@ class MagicFS:
             - a writable file object
             - a function taking one parameter, the string to write
             - a function taking two parameters, a byte string and offset
+            - a generator, which is sent each part of the string as it is
+              written (reordered by offset, with gaps filled by zeroes), and
+              closed when the file is closed
+
+        When the callback takes the whole string, written data is buffered
+        in memory until it exceeds spill_size bytes, after which it is kept
+        in a temporary file until the file is closed. If spill_size=None,
+        data is always kept in memory.
         '''
 
-        self.fs.onwrite(route, func, encoding)
+        self.fs.onwrite(route, func, encoding, spill_size=spill_size)
 
-    def onlist(self, route, func):
+    def onlist(self, route, func, ttl=None, attr_ttl=1):
         '''
         Register a callback for listdir requests.
 
         The callback can return:
-            - an iterable (or generator)
+            - an iterable (or generator) of names
+            - an iterable (or generator) of (name, attrs) pairs, where attrs
+              is anything a stat callback can return
+
+        Entries are only taken from the iterable as they are needed, so huge
+        directories can be listed without producing every name at once.
+
+        If ttl is given, the full listing is cached for that many seconds, or
+        until invalidate() is called.
+
+        Attributes listed with names are used in place of the stat callback
+        for those files for attr_ttl seconds, so that listing a directory
+        along with the attributes of its files (like ls -l) needs only one
+        callback.
         '''
 
-        self.fs.onlist(route, func)
+        self.fs.onlist(route, func, ttl=ttl, attr_ttl=attr_ttl)
 
-    def onstat(self, route, func):
+    def onstat(self, route, func, ttl=None):
         '''
         Register a callback for file stat requests.
 
@@ -134,15 +399,20 @@ class MagicFS:
                 - 'st_mode'
                 - 'st_nlink'
                 - 'st_size'
+            - an os.stat_result, such as from os.stat()
 
         Note that for 'st_mode', you should use the bitwise 'or' to combine the
         file type and the file permissions, e.g. FileType.REGULAR | 0o644.
 
         If the callback throws a FileNotFoundException, it will be interpreted
         as a sign that the indicated file does not exist.
+
+        If ttl is given, the results of the callback (including missing
+        files) are cached for that many seconds, or until the file is
+        written to or invalidate() is called.
         '''
 
-        self.fs.onstat(route, func)
+        self.fs.onstat(route, func, ttl=ttl)
 
     def onreadlink(self, route, func):
         '''
@@ -154,6 +424,53 @@ class MagicFS:
 
         self.fs.onreadlink(route, func)
 
+    def onmanifest(self, route, manifest, func=None, encoding='utf-8',
+                   **options):
+        '''
+        Register a whole namespace of files at once, below the directory
+        route.
+
+        The manifest can be a Manifest, a mapping or iterable of (path,
+        value) pairs, or the name of a file to load one from (see
+        Manifest.load()). Each value is either the contents of the file (a
+        string or bytes), its size, or None. The files in the manifest are
+        stored compactly, rather than as a route each, so very many files
+        can be registered quickly.
+
+        If func is given, it is called for reads of every file, as a read
+        callback, with the path within the manifest as the parameter path
+        (as a tuple of components); otherwise files are read from their
+        values. Other options are as for onread().
+        '''
+
+        if isinstance(manifest, str):
+            manifest = Manifest.load(manifest)
+        elif not isinstance(manifest, Manifest):
+            manifest = Manifest(manifest)
+
+        self.fs.onmanifest(route, manifest, func, encoding, **options)
+        return manifest
+
+    def onarchive(self, route, path, table=None, **options):
+        '''
+        Serve the files in an archive, read-only, below the directory route.
+
+        The archive can be a zip file, a tar file (optionally compressed),
+        or a table in an SQLite database (with the name of the table given,
+        and its files in rows with name and data columns, which can be
+        renamed using the name and data options). The archive is indexed
+        once, when registered, and files are read from it as they are
+        needed, without extracting them.
+
+        Uncompressed files are read directly from the archive, while
+        compressed files are decompressed as they are read.
+        '''
+
+        archive = open_archive(path, table, **options)
+        self.fs.onmanifest(route, archive.manifest,
+                           lambda path, ps: archive.read(ps.path), None)
+        return archive
+
     # Callbacks (decorators)
     # ======================
 
@@ -174,7 +491,9 @@ class MagicFS:
             return cls
         return decorator
 
-    def read(self, route, encoding='utf-8'):
+    def read(self, route, encoding='utf-8', sequential=False,
+             direct_io=True, keep_cache=False, block_cache=False,
+             process=False, readahead=0):
         '''
         Register a callback for read requests using a function decorator.
 
@@ -182,11 +501,26 @@ class MagicFS:
         '''
 
         def decorator(func):
-            self.onread(route, func, encoding)
+            self.onread(route, func, encoding, sequential, direct_io,
+                        keep_cache, block_cache, process, readahead)
+            return func
+        return decorator
+
+    def manifest(self, route, manifest, encoding='utf-8', **options):
+        '''
+        Register a read callback for a whole namespace of files using a
+        function decorator.
+
+        See onmanifest().
+        '''
+
+        def decorator(func):
+            self.onmanifest(route, manifest, func, encoding, **options)
             return func
         return decorator
 
-    def write(self, route, encoding='utf-8'):
+    def write(self, route, encoding='utf-8',
+              spill_size=FileWriter.Full.SPILL_SIZE):
         '''
         Register a callback for write requests using a function decorator.
 
@@ -194,11 +528,11 @@ class MagicFS:
         '''
 
         def decorator(func):
-            self.onwrite(route, func, encoding)
+            self.onwrite(route, func, encoding, spill_size)
             return func
         return decorator
 
-    def list(self, route):
+    def list(self, route, ttl=None, attr_ttl=1):
         '''
         Register a callback for listdir requests using a function decorator.
 
@@ -206,11 +540,11 @@ class MagicFS:
         '''
 
         def decorator(func):
-            self.onlist(route, func)
+            self.onlist(route, func, ttl, attr_ttl)
             return func
         return decorator
 
-    def stat(self, route):
+    def stat(self, route, ttl=None):
         '''
         Register a callback for stat requests using a function decorator.
 
@@ -218,7 +552,7 @@ class MagicFS:
         '''
 
         def decorator(func):
-            self.onstat(route, func)
+            self.onstat(route, func, ttl)
             return func
         return decorator
 
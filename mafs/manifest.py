@@ -0,0 +1,123 @@
+import bisect
+import posixpath
+
+from collections.abc import Mapping
+
+
+class Manifest:
+    '''
+    A large, static namespace of files, each with a value: either its
+    contents (a string or bytes), its size (an int, or any object with an
+    int size attribute), or None.
+
+    Files are kept as a single sorted array of their full paths, rather than
+    a tree of nodes. All the paths in a directory share a prefix, so are
+    stored next to each other; looking up a file or listing a directory is
+    done by binary search, and directories are never stored.
+    '''
+
+    def __init__(self, entries):
+        if isinstance(entries, Mapping):
+            entries = entries.items()
+
+        paths = []
+        values = []
+        entries = ((_normalize(path), value) for path, value in entries)
+        for path, value in sorted(entries, key=lambda entry: entry[0]):
+            if paths and path == paths[-1]:
+                raise ManifestError(path + ' is listed more than once')
+            paths.append(path)
+            values.append(value)
+
+        self.paths = tuple(paths)
+        self.values = tuple(values)
+
+        for path in self.paths:
+            if self.isdir(path):
+                raise ManifestError(path + ' is both a file and a directory')
+
+    @classmethod
+    def load(cls, file):
+        '''
+        Load a manifest from a file (or path to one) with a line per file,
+        containing its path, optionally followed by a tab and its size.
+        '''
+
+        if isinstance(file, str):
+            with open(file) as f:
+                return cls.load(f)
+
+        def entries():
+            for line in file:
+                line = line.rstrip('\n')
+                if not line:
+                    continue
+
+                path, _, size = line.partition('\t')
+                yield path, int(size) if size else None
+        return cls(entries())
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __contains__(self, path):
+        return self._index(_normalize(path)) is not None
+
+    def get(self, path, default=None):
+        index = self._index(_normalize(path))
+        if index is None:
+            return default
+        return self.values[index]
+
+    def isdir(self, path):
+        path = _normalize(path)
+        prefix = path + '/' if path else ''
+
+        index = bisect.bisect_left(self.paths, prefix)
+        return index < len(self.paths) and \
+            self.paths[index].startswith(prefix)
+
+    def list(self, path):
+        '''
+        Generate the entries of a directory, as tuples of (name, value,
+        directory), where directory is True for subdirectories (which have
+        no value).
+        '''
+
+        path = _normalize(path)
+        prefix = path + '/' if path else ''
+
+        index = bisect.bisect_left(self.paths, prefix)
+        while index < len(self.paths):
+            entry = self.paths[index]
+            if not entry.startswith(prefix):
+                break
+
+            name, sep, _ = entry[len(prefix):].partition('/')
+            if sep:
+                # skip everything else in the subdirectory, which sorts
+                # before anything following a '/' ('0' is just after it)
+                yield name, None, True
+                index = bisect.bisect_left(self.paths, prefix + name + '0',
+                                           index)
+            else:
+                yield name, self.values[index], False
+                index += 1
+
+    def _index(self, path):
+        index = bisect.bisect_left(self.paths, path)
+        if index < len(self.paths) and self.paths[index] == path:
+            return index
+        return None
+
+
+class ManifestError(Exception):
+    pass
+
+
+def _normalize(path):
+    # paths are relative to the root of the manifest, without '.', '..' or
+    # empty components, so that paths from find or tar can be used as-is
+    if isinstance(path, tuple):
+        path = '/'.join(path)
+    return posixpath.normpath('/' + path).lstrip('/')
@@ -0,0 +1,152 @@
+import bisect
+import threading
+
+from .hooks import Hook
+
+
+class Metrics(Hook):
+    '''
+    Counts, byte totals and latency histograms of filesystem operations,
+    kept separately for each operation and matched route.
+    '''
+
+    # upper bounds of the latency histogram buckets, in seconds
+    BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10)
+
+    def __init__(self):
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def after(self, op, path, route, state, duration, result=None,
+              error=None):
+        size = 0
+        if error is None:
+            if op == 'read' and result:
+                size = len(result)
+            elif op == 'write':
+                size = result
+        self.record(op, route, duration, size, error is not None)
+
+    def record(self, operation, route, duration, size=0, error=False):
+        bucket = bisect.bisect_left(self.BUCKETS, duration)
+
+        with self._lock:
+            stats = self._stats.get((operation, route))
+            if stats is None:
+                stats = self._stats[(operation, route)] = Stats(
+                    len(self.BUCKETS) + 1)
+
+            stats.count += 1
+            stats.errors += error
+            stats.bytes += size
+            stats.seconds += duration
+            stats.buckets[bucket] += 1
+
+    def snapshot(self):
+        '''
+        Get the current metrics, as a mapping of operations to mappings of
+        routes to their metrics.
+
+        Latencies are given as a list of (upper bound, count) pairs, where
+        each count includes all faster operations.
+        '''
+
+        bounds = self.BUCKETS + (float('inf'),)
+
+        with self._lock:
+            stats = [(key, value.copy()) for key, value in self._stats.items()]
+
+        snapshot = {}
+        for (operation, route), value in sorted(stats, key=_sort_key):
+            cumulative = 0
+            latency = []
+            for bound, count in zip(bounds, value.buckets):
+                cumulative += count
+                latency.append((bound, cumulative))
+
+            snapshot.setdefault(operation, {})[route] = {
+                'count': value.count,
+                'errors': value.errors,
+                'bytes': value.bytes,
+                'seconds': value.seconds,
+                'latency': latency,
+            }
+        return snapshot
+
+    def render(self):
+        '''
+        Render the current metrics in the Prometheus text format.
+        '''
+
+        families = {
+            'mafs_operations_total': ('counter', []),
+            'mafs_errors_total': ('counter', []),
+            'mafs_bytes_total': ('counter', []),
+            'mafs_latency_seconds': ('histogram', []),
+        }
+
+        def add(family, name, labels, value):
+            families[family][1].append('{}{{{}}} {}'.format(name, labels,
+                                                            value))
+
+        for operation, routes in self.snapshot().items():
+            for route, value in routes.items():
+                labels = 'operation="{}",route="{}"'.format(
+                    _escape(operation), _escape(route or ''))
+
+                add('mafs_operations_total', 'mafs_operations_total', labels,
+                    value['count'])
+                add('mafs_errors_total', 'mafs_errors_total', labels,
+                    value['errors'])
+                add('mafs_bytes_total', 'mafs_bytes_total', labels,
+                    value['bytes'])
+
+                for bound, count in value['latency']:
+                    bound = '+Inf' if bound == float('inf') else repr(bound)
+                    add('mafs_latency_seconds', 'mafs_latency_seconds_bucket',
+                        '{},le="{}"'.format(labels, bound), count)
+                add('mafs_latency_seconds', 'mafs_latency_seconds_sum',
+                    labels, repr(value['seconds']))
+                add('mafs_latency_seconds', 'mafs_latency_seconds_count',
+                    labels, value['count'])
+
+        lines = []
+        for family, (kind, samples) in families.items():
+            lines.append('# TYPE {} {}'.format(family, kind))
+            lines.extend(samples)
+
+        return '\n'.join(lines) + '\n'
+
+    def clear(self):
+        with self._lock:
+            self._stats.clear()
+
+
+class Stats:
+    __slots__ = ('count', 'errors', 'bytes', 'seconds', 'buckets')
+
+    def __init__(self, buckets):
+        self.count = 0
+        self.errors = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.buckets = [0] * buckets
+
+    def copy(self):
+        stats = Stats(0)
+        stats.count = self.count
+        stats.errors = self.errors
+        stats.bytes = self.bytes
+        stats.seconds = self.seconds
+        stats.buckets = list(self.buckets)
+        return stats
+
+
+def _sort_key(item):
+    (operation, route), _ = item
+    return (operation, route or '')
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
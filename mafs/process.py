@@ -0,0 +1,88 @@
+import asyncio
+import inspect
+import threading
+import multiprocessing
+
+from collections import namedtuple
+from multiprocessing import resource_tracker
+from multiprocessing import shared_memory
+
+from . import file
+
+
+class ProcessPool:
+    '''
+    A pool of worker processes for producing file contents.
+
+    Contents are produced in full by a worker, and returned through shared
+    memory rather than being pickled. Workers are forked, so that callbacks
+    defined in the main script can be used. Forking is only safe before any
+    other threads are started, so the pool should be started with start()
+    before mounting if it is required; otherwise it is started once it is
+    first needed.
+    '''
+
+    def __init__(self, processes=None):
+        self.processes = processes
+        self.pool = None
+
+        # whether any routes use the pool
+        self.required = False
+
+        self._lock = threading.Lock()
+
+    def read(self, callback, path, parameters, encoding):
+        fields = parameters._fields
+        values = tuple(parameters)
+
+        name, size = self.start().apply(_render, (callback, path, fields,
+                                                  values, encoding))
+        return file.FileReader.Shared(name, size)
+
+    def stop(self):
+        with self._lock:
+            if self.pool is not None:
+                self.pool.terminate()
+                self.pool.join()
+                self.pool = None
+
+    def start(self):
+        with self._lock:
+            if self.pool is None:
+                context = multiprocessing.get_context('fork')
+                self.pool = context.Pool(self.processes)
+            return self.pool
+
+
+def _render(callback, path, fields, values, encoding):
+    parameters = namedtuple('Parameters', fields)(*values)
+
+    contents = callback(path, parameters)
+    if inspect.isawaitable(contents):
+        contents = asyncio.run(contents)
+
+    # read everything using the usual readers
+    data = bytearray()
+    if contents:
+        reader = file.FileReader.create(contents, encoding)
+        try:
+            while True:
+                part = reader.read(CHUNK_SIZE, len(data))
+                if not part:
+                    break
+                data += part
+        finally:
+            reader.release()
+
+    # shared memory cannot be empty
+    memory = shared_memory.SharedMemory(create=True, size=max(len(data), 1))
+    memory.buf[:len(data)] = data
+
+    # the memory is now owned by the parent, which unlinks it once released
+    resource_tracker.unregister(memory._name, 'shared_memory')
+    memory.close()
+
+    return memory.name, len(data)
+
+
+CHUNK_SIZE = 1024 * 1024
@@ -1,34 +1,77 @@
 import os
+import types
+import functools
 
 from collections import namedtuple
 
 
 class Router:
-    def __init__(self):
+    '''
+    A table of routes, each associated with some data.
+
+    Routes may be registered under different keys, so that a single table can
+    hold several independent sets of routes. The root route is always matched
+    for every key given on creation.
+    '''
+
+    def __init__(self, keys=(None,), cache_size=1024):
         self.root = Node()
+        self.root.keys.update(keys)
+
+        self._matcher = None
+        self._cache = functools.lru_cache(maxsize=cache_size)(self._resolve)
 
-    def add(self, route, data):
+    def add(self, route, data, key=None):
         route = self._split_route(route)
 
-        self.root.add(route, data)
+        self.root.add(route, data, key)
+        self._matcher = None
+        self._cache.cache_clear()
+
+    def lookup(self, route, key=None):
+        return self.resolve(route).get(key)
+
+    def resolve(self, route):
+        '''
+        Lookup a route for every key at once, returning a mapping of keys to
+        results.
+        '''
+
+        return self._cache(route)
 
-    def lookup(self, route):
+    def list(self, route, key=None):
         route = self._split_route(route)
 
-        result = self.root.find(route)
-        if result:
-            result.data = result.data.final
-        return result
+        for node, parameters in self.matcher.match(route, {key}):
+            keys = [name for name, child in node.routes.items()
+                    if key in child.keys]
+            return Result(keys, parameters, node.pattern)
+        return None
 
-    def list(self, route):
+    def cache_info(self):
+        return self._cache.cache_info()
+
+    @property
+    def matcher(self):
+        matcher = self._matcher
+        if matcher is None:
+            matcher = self._matcher = Matcher(self.root)
+        return matcher
+
+    def _resolve(self, route):
         route = self._split_route(route)
 
-        result = self.root.find(route)
-        if result:
-            keys = result.data.routes.keys()
-            keys = list(keys)
-            result.data = keys
-        return result
+        results = {}
+        pending = set(self.root.keys)
+        for node, parameters in self.matcher.match(route):
+            for key in node.keys & pending:
+                results[key] = Result(node.final.get(key), parameters,
+                                      node.pattern)
+            pending -= node.keys
+            if not pending:
+                break
+
+        return types.MappingProxyType(results)
 
     def _split_route(self, route):
         route = os.path.normpath(route)
@@ -40,87 +83,192 @@ class Router:
 
 
 class Node:
-    def __init__(self):
-        self.final = None
+    def __init__(self, pattern='/'):
+        # the route leading to this node, as it was registered
+        self.pattern = pattern
+
+        self.final = {}
+        self.keys = set()
 
         self.routes = {}
         self.vroutes = {}
         self.rroutes = {}
 
-    def add(self, route, data):
-        if route:
-            first, rest = route[0], route[1:]
-
-            if first.startswith(':'):
-                first = first[1:]
-                if first not in self.vroutes:
-                    self.vroutes[first] = Node()
-                self.vroutes[first].add(rest, data)
-            elif first.startswith('*'):
-                first = first[1:]
-                if first not in self.rroutes:
-                    self.rroutes[first] = Node()
-                self.rroutes[first].add(rest, data)
+    def add(self, route, data, key=None):
+        node = self
+        node.keys.add(key)
+
+        for depth, part in enumerate(route, 1):
+            if part.startswith(':'):
+                children, part = node.vroutes, part[1:]
+            elif part.startswith('*'):
+                children, part = node.rroutes, part[1:]
             else:
-                if first not in self.routes:
-                    self.routes[first] = Node()
-                self.routes[first].add(rest, data)
-        else:
-            if self.final:
-                raise RoutingError('node already has assigned value')
-            self.final = data
-
-    def find(self, route):
-        if route:
-            first, rest = route[0], route[1:]
-
-            if first in self.routes:
-                result = self.routes[first].find(rest)
-                if result:
-                    return result
-
-            for var in self.vroutes:
-                result = self.vroutes[var].find(rest)
-                if result:
-                    result.parameter(var, first)
-                    return result
-
-            for var in self.rroutes:
-                vals = []
-                while rest:
-                    vals.append(first)
-
-                    result = self.rroutes[var].find(rest)
-                    if result:
-                        result.parameter(var, vals)
-                        return result
-
-                    first, rest = rest[0], rest[1:]
-
-                vals.append(first)
-                result = Result(self.rroutes[var])
-                result.parameter(var, vals)
-                return result
-
-            return None
-        else:
-            return Result(self)
+                children = node.routes
+
+            if part not in children:
+                children[part] = Node('/' + '/'.join(route[:depth]))
+            node = children[part]
+            node.keys.add(key)
+
+        if node.final.get(key):
+            raise RoutingError('node already has assigned value')
+        node.final[key] = data
+
+
+class Matcher:
+    '''
+    A compiled, flat form of a tree of nodes.
+
+    Each node is given an index, and its children are stored in tables
+    indexed by it. Matching then advances every candidate node at once, one
+    path component at a time, keeping candidates in order of precedence
+    (static routes, then variables, then recursive variables). As each node
+    is only kept once per component, matching takes time linear in the depth
+    of the path, and never recurses.
+    '''
+
+    def __init__(self, root):
+        self.nodes = []
+        self.keys = []
+        self.static = []
+        self.variables = []
+        self.recursive = []
+        self.loops = []
+
+        # nodes entered via a recursive variable loop back to themselves,
+        # and are labelled by the name of that variable
+        indexes = {}
+        stack = [(root, None)]
+        while stack:
+            node, loop = stack.pop()
+            indexes[id(node)] = len(self.nodes)
+
+            self.nodes.append(node)
+            self.keys.append(frozenset(node.keys))
+            self.loops.append(loop)
+
+            stack.extend((child, None) for child in node.routes.values())
+            stack.extend((child, None) for child in node.vroutes.values())
+            stack.extend((child, name)
+                         for name, child in node.rroutes.items())
+
+        for node in self.nodes:
+            self.static.append({name: indexes[id(child)]
+                                for name, child in node.routes.items()})
+            self.variables.append([(name, indexes[id(child)])
+                                   for name, child in node.vroutes.items()])
+            self.recursive.append([(name, indexes[id(child)])
+                                   for name, child in node.rroutes.items()])
+
+    def match(self, route, keys=None):
+        '''
+        Generate the nodes matching a route, in order of precedence, along
+        with their parameters.
+
+        If keys are provided, only nodes that have one of those keys are
+        considered.
+        '''
+
+        # each thread is a node index, the captured parameters (as a linked
+        # list of (name, start, end, recursive)), and the start of the
+        # recursive variable currently being consumed, if any
+        threads = [(0, None, None)]
+
+        for position, part in enumerate(route):
+            seen = set()
+            advanced = []
+
+            def advance(index, captures, start):
+                if index in seen:
+                    return
+                if keys is not None and not self.keys[index] & keys:
+                    return
+                seen.add(index)
+                advanced.append((index, captures, start))
+
+            for index, captures, start in threads:
+                closed = captures
+                if start is not None:
+                    name = self.loops[index]
+                    closed = ((name, start, position, True), captures)
+
+                child = self.static[index].get(part)
+                if child is not None:
+                    advance(child, closed, None)
+                for name, child in self.variables[index]:
+                    advance(child, ((name, position, position + 1, False),
+                                    closed), None)
+                for name, child in self.recursive[index]:
+                    advance(child, closed, position)
+                if self.loops[index] is not None:
+                    advance(index, captures, start)
+
+            threads = advanced
+            if not threads:
+                return
+
+        for index, captures, start in threads:
+            if start is not None:
+                name = self.loops[index]
+                captures = ((name, start, len(route), True), captures)
+            yield (self.nodes[index], self._parameters(route, captures))
+
+    def _parameters(self, route, captures):
+        parameters = []
+        while captures:
+            (name, start, end, recursive), captures = captures
+            if recursive:
+                parameters.append((name, tuple(route[start:end])))
+            else:
+                parameters.append((name, route[start]))
+
+        parameters.reverse()
+        return tuple(parameters)
 
 
 class Result:
-    def __init__(self, data):
-        self.data = data
+    '''
+    The outcome of a route lookup.
+
+    Results may be shared between lookups of the same path, so they are
+    read-only once created.
+    '''
+
+    __slots__ = ('_data', '_parameters', '_route')
 
-        self._parameters = {}
+    def __init__(self, data, parameters=(), route=None):
+        # outer parameters take precedence over inner ones of the same name
+        values = {}
+        for param, value in parameters:
+            values.setdefault(param, value)
 
-    def parameter(self, param, data):
-        self._parameters[param] = data
+        Parameters = _parameters_type(tuple(values.keys()))
+
+        object.__setattr__(self, '_data', data)
+        object.__setattr__(self, '_parameters', Parameters(**values))
+        object.__setattr__(self, '_route', route)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('route results are read-only')
+
+    @property
+    def data(self):
+        return self._data
 
     @property
     def parameters(self):
-        Parameters = namedtuple('Parameters', self._parameters.keys())
-        return Parameters(**self._parameters)
+        return self._parameters
+
+    @property
+    def route(self):
+        return self._route
 
 
 class RoutingError(Exception):
     pass
+
+
+@functools.lru_cache(maxsize=None)
+def _parameters_type(fields):
+    return namedtuple('Parameters', fields)
@@ -0,0 +1,252 @@
+import os
+import time
+import queue
+import struct
+import threading
+
+from types import SimpleNamespace
+from collections import namedtuple
+
+import fuse
+
+from .hooks import Hook
+
+# the operations that are recorded, each stored as its index
+OPERATIONS = ('getattr', 'readlink', 'opendir', 'readdir', 'releasedir',
+              'open', 'read', 'write', 'truncate', 'release')
+
+# operations on an open handle, which must be replayed in order
+HANDLE_OPERATIONS = {'opendir', 'readdir', 'releasedir', 'open', 'read',
+                     'write', 'release'}
+
+MAGIC = b'MAFSTRACE1'
+
+# a trace is a sequence of records, each starting with a kind, which is
+# either the index of an operation, or marks the definition of a path, which
+# is then referred to by the order it was defined in
+_PATH = 0xff
+_PATH_RECORD = struct.Struct('<BH')
+_OPERATION_RECORD = struct.Struct('<BBIddQQQI')
+
+Record = namedtuple('Record', ['op', 'path', 'start', 'duration', 'offset',
+                               'length', 'handle', 'flags', 'error'])
+
+
+class Recorder(Hook):
+    '''
+    A hook that records the operations on a filesystem to a trace file, to
+    be replayed later.
+
+    Each record holds the operation and path, its start time (relative to
+    the start of the trace) and duration, and any offset, length, handle
+    and flags it used. Data that is read or written is not recorded.
+    '''
+
+    def __init__(self, path):
+        self.file = open(path, 'wb')
+        self.file.write(MAGIC)
+
+        self.paths = {}
+        self.start = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def before(self, op, path, route, args):
+        if op in _CODES:
+            return args
+        return None
+
+    def after(self, op, path, route, state, duration, result=None,
+              error=None):
+        if state is None:
+            return
+
+        start = time.perf_counter() - duration - self.start
+        offset, length, handle, flags = _fields(op, state, result)
+
+        with self._lock:
+            if self.file.closed:
+                return
+
+            index = self.paths.get(path)
+            if index is None:
+                index = self.paths[path] = len(self.paths)
+                encoded = path.encode('utf-8', 'surrogateescape')
+                self.file.write(_PATH_RECORD.pack(_PATH, len(encoded)))
+                self.file.write(encoded)
+
+            self.file.write(_OPERATION_RECORD.pack(
+                _CODES[op], error is not None, index, start, duration,
+                offset, length, handle, flags))
+
+    def close(self):
+        with self._lock:
+            self.file.close()
+
+
+def read(path):
+    '''
+    Generate the records of a trace file.
+
+    A trace that was cut short (for example, if the filesystem was killed)
+    ends at its last complete record.
+    '''
+
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise TraceError(path + ' is not a trace file')
+
+        paths = []
+        while True:
+            kind = f.read(1)
+            if not kind:
+                return
+
+            if kind[0] == _PATH:
+                data = kind + f.read(_PATH_RECORD.size - 1)
+                if len(data) < _PATH_RECORD.size:
+                    return
+                _, length = _PATH_RECORD.unpack(data)
+                encoded = f.read(length)
+                if len(encoded) < length:
+                    return
+                paths.append(encoded.decode('utf-8', 'surrogateescape'))
+            else:
+                data = kind + f.read(_OPERATION_RECORD.size - 1)
+                if len(data) < _OPERATION_RECORD.size:
+                    return
+                (code, error, index, start, duration, offset, length, handle,
+                 flags) = _OPERATION_RECORD.unpack(data)
+                yield Record(OPERATIONS[code], paths[index], start, duration,
+                             offset, length, handle, flags, bool(error))
+
+
+def replay(fs, records, speed=1.0, concurrency=1):
+    '''
+    Replay trace records against a FileSystem, in-process.
+
+    Operations are started at the times they were recorded, sped up by the
+    given factor; if speed is None or 0, they are replayed as fast as
+    possible. Operations are spread between concurrency threads, with all
+    the operations on a handle replayed in order by the same thread.
+
+    Returns a summary of the number of operations replayed, the number that
+    failed, and the time taken in seconds.
+    '''
+
+    handles = {}
+    summary = {'operations': 0, 'errors': 0, 'seconds': 0.0}
+    lock = threading.Lock()
+
+    def work(records):
+        while True:
+            record = records.get()
+            if record is None:
+                return
+
+            try:
+                _execute(fs, record, handles)
+                error = False
+            except Exception:
+                error = True
+
+            with lock:
+                summary['operations'] += 1
+                summary['errors'] += error
+
+    # outside of a mount, there is no context to get the caller from
+    context = (os.getuid(), os.getgid(), os.getpid())
+    get_context = fuse.fuse_get_context
+    fuse.fuse_get_context = lambda: context
+
+    queues = [queue.SimpleQueue() for _ in range(concurrency)]
+    workers = [threading.Thread(target=work, args=(q,), daemon=True)
+               for q in queues]
+    for worker in workers:
+        worker.start()
+
+    begin = time.perf_counter()
+    try:
+        for i, record in enumerate(records):
+            if speed:
+                delay = begin + record.start / speed - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+
+            if record.op in HANDLE_OPERATIONS:
+                queues[record.handle % concurrency].put(record)
+            else:
+                queues[i % concurrency].put(record)
+    finally:
+        for q in queues:
+            q.put(None)
+        for worker in workers:
+            worker.join()
+
+        fuse.fuse_get_context = get_context
+
+    summary['seconds'] = time.perf_counter() - begin
+    return summary
+
+
+class TraceError(Exception):
+    pass
+
+
+_CODES = {op: code for code, op in enumerate(OPERATIONS)}
+
+
+def _fields(op, args, result):
+    # the offset, length, handle and flags of an operation
+    if op == 'opendir':
+        return 0, 0, result or 0, 0
+    elif op == 'readdir':
+        return args[2] if len(args) > 2 else 0, 0, args[1] or 0, 0
+    elif op == 'releasedir':
+        return 0, 0, args[1] or 0, 0
+    elif op == 'open':
+        fi = args[1]
+        return 0, 0, getattr(fi, 'fh', 0) or 0, fi.flags
+    elif op == 'read':
+        return args[2], args[1], args[3].fh, 0
+    elif op == 'write':
+        return args[2], len(args[1]), args[3].fh, 0
+    elif op == 'truncate':
+        return 0, args[1], 0, 0
+    elif op == 'release':
+        return 0, 0, args[1].fh, 0
+    return 0, 0, 0, 0
+
+
+def _execute(fs, record, handles):
+    op, path = record.op, record.path
+
+    if op == 'open':
+        fi = SimpleNamespace(flags=record.flags, fh=0, direct_io=False,
+                             keep_cache=False)
+        handles[record.handle] = fi
+        fs('open', path, fi)
+    elif op == 'opendir':
+        handles[record.handle] = fs('opendir', path)
+    elif op == 'readdir':
+        for _ in fs('readdir', path, handles.get(record.handle),
+                    record.offset):
+            pass
+    elif op == 'releasedir':
+        fs('releasedir', path, handles.pop(record.handle, None))
+    elif op in ('read', 'write', 'release'):
+        fi = handles.get(record.handle)
+        if fi is None:
+            # the file was opened before the trace started
+            fi = SimpleNamespace(flags=0, fh=None)
+
+        if op == 'read':
+            fs('read', path, record.length, record.offset, fi)
+        elif op == 'write':
+            fs('write', path, bytes(record.length), record.offset, fi)
+        else:
+            handles.pop(record.handle, None)
+            fs('release', path, fi)
+    elif op == 'truncate':
+        fs('truncate', path, record.length)
+    else:
+        fs(op, path)
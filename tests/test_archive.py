@@ -0,0 +1,144 @@
+import io
+import os
+import stat
+import sqlite3
+import tarfile
+import zipfile
+import unittest
+import tempfile
+from unittest import mock
+from types import SimpleNamespace
+
+from mafs import archive
+from mafs import filesystem
+
+FILES = {
+    'a/small.txt': b'hello world',
+    'a/b/big.bin': bytes(range(256)) * 400,
+    'empty': b'',
+}
+
+
+def _read(fs, path):
+    fi = SimpleNamespace(flags=os.O_RDONLY)
+    fs.open(path, fi)
+
+    data = bytes()
+    while True:
+        part = fs.read(path, 4096, len(data), fi)
+        if not part:
+            break
+        data += bytes(part)
+
+    fs.release(path, fi)
+    return data
+
+
+@mock.patch('fuse.fuse_get_context', lambda: (1000, 1000, 1))
+class ArchiveTests(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def check(self, a):
+        self.addCleanup(a.close)
+
+        fs = filesystem.FileSystem()
+        fs.onmanifest('/archive', a.manifest,
+                      lambda path, ps: a.read(ps.path), None)
+
+        for name, data in FILES.items():
+            path = '/archive/' + name
+            self.assertEqual(fs.getattr(path)['st_size'], len(data))
+            self.assertEqual(_read(fs, path), data)
+
+        attrs = fs.getattr('/archive/a/b')
+        self.assertEqual(stat.S_IFMT(attrs['st_mode']), stat.S_IFDIR)
+
+        names = [name for name, _, _ in fs.readdir('/archive', None)]
+        self.assertEqual(names, ['.', '..', 'a', 'empty'])
+        names = [name for name, _, _ in fs.readdir('/archive/a', None)]
+        self.assertEqual(names, ['.', '..', 'b', 'small.txt'])
+
+        # reads at an offset
+        fi = SimpleNamespace(flags=os.O_RDONLY)
+        fs.open('/archive/a/b/big.bin', fi)
+        self.assertEqual(bytes(fs.read('/archive/a/b/big.bin', 10, 300, fi)),
+                         FILES['a/b/big.bin'][300:310])
+        fs.release('/archive/a/b/big.bin', fi)
+
+    def test_zip(self):
+        path = os.path.join(self.directory, 'files.zip')
+        with zipfile.ZipFile(path, 'w') as z:
+            z.writestr('a/', b'')
+            z.writestr('a/small.txt', FILES['a/small.txt'])
+            z.writestr('a/b/big.bin', FILES['a/b/big.bin'],
+                       compress_type=zipfile.ZIP_DEFLATED)
+            z.writestr('empty', FILES['empty'])
+
+        a = archive.open_archive(path)
+        self.assertIsInstance(a, archive.ZipArchive)
+        self.check(a)
+
+    def test_empty(self):
+        path = os.path.join(self.directory, 'empty.zip')
+        zipfile.ZipFile(path, 'w').close()
+
+        a = archive.open_archive(path)
+        self.addCleanup(a.close)
+        fs = filesystem.FileSystem()
+        fs.onmanifest('/archive', a.manifest,
+                      lambda path, ps: a.read(ps.path), None)
+
+        names = [name for name, _, _ in fs.readdir('/archive', None)]
+        self.assertEqual(names, ['.', '..'])
+
+    def test_tar(self):
+        # archives made with tar -C directory . have names starting with ./
+        for mode, prefix in [('w', ''), ('w:gz', ''), ('w', './'),
+                             ('w:gz', './')]:
+            path = os.path.join(self.directory, 'files.tar')
+            with tarfile.open(path, mode) as t:
+                if prefix:
+                    info = tarfile.TarInfo('.')
+                    info.type = tarfile.DIRTYPE
+                    t.addfile(info)
+
+                for name, data in FILES.items():
+                    info = tarfile.TarInfo(prefix + name)
+                    info.size = len(data)
+                    t.addfile(info, io.BytesIO(data))
+
+            a = archive.open_archive(path)
+            self.assertIsInstance(a, archive.TarArchive)
+            offsets = [member.offset for member in a.manifest.values]
+            self.assertEqual(None in offsets, mode == 'w:gz')
+            self.check(a)
+
+    def test_sqlite(self):
+        path = os.path.join(self.directory, 'files.db')
+        db = sqlite3.connect(path)
+        db.execute('CREATE TABLE files (path TEXT PRIMARY KEY, contents BLOB)')
+        db.executemany('INSERT INTO files VALUES (?, ?)', FILES.items())
+        db.execute('CREATE TABLE texts (name TEXT, data TEXT)')
+        db.execute('INSERT INTO texts VALUES (?, ?)', ('text', 'h\xe9llo'))
+        db.commit()
+        db.close()
+
+        with self.assertRaises(archive.ArchiveError):
+            archive.open_archive(path)
+
+        a = archive.open_archive(path, 'files', name='path', data='contents')
+        self.assertIsInstance(a, archive.SQLiteArchive)
+        self.check(a)
+
+        # text is read as its encoded bytes
+        a = archive.open_archive(path, 'texts')
+        self.addCleanup(a.close)
+        self.assertEqual(a.manifest.get('text').size, 6)
+        self.assertEqual(a.read('text')(100, 1), 'h\xe9llo'.encode()[1:])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,61 @@
+import unittest
+
+from mafs import cache
+
+
+class TTLCacheTests(unittest.TestCase):
+    def test_expiry(self):
+        now = [0]
+        c = cache.TTLCache(clock=lambda: now[0])
+
+        c.set('short', 'value', ttl=1)
+        c.set('forever', 'value')
+        self.assertEqual(c.get('short'), 'value')
+
+        now[0] = 2
+        self.assertEqual(c.get('short'), None)
+        self.assertEqual(c.get('forever'), 'value')
+
+    def test_eviction(self):
+        c = cache.TTLCache(maxsize=2)
+        c.set('a', 1)
+        c.set('b', 2)
+        c.get('a')
+        c.set('c', 3)
+
+        self.assertEqual(c.get('a'), 1)
+        self.assertEqual(c.get('b'), None)
+        self.assertEqual(c.get('c'), 3)
+
+
+class BlockCacheTests(unittest.TestCase):
+    def test_capacity(self):
+        c = cache.BlockCache(capacity=10, block_size=4)
+        c.set('/a', 0, b'aaaa')
+        c.set('/a', 1, b'aaaa')
+        c.get('/a', 0)
+        c.set('/b', 0, b'bbbb')
+
+        self.assertEqual(c.size, 8)
+        self.assertEqual(c.get('/a', 0), b'aaaa')
+        self.assertEqual(c.get('/a', 1), None)
+        self.assertEqual(c.get('/b', 0), b'bbbb')
+
+    def test_invalidate(self):
+        c = cache.BlockCache(block_size=4)
+        c.set('/a', 0, b'aaaa')
+        c.set('/a', 1, b'aa')
+        c.set('/b', 0, b'bbbb')
+
+        c.invalidate('/a')
+        self.assertEqual(c.get('/a', 0), None)
+        self.assertEqual(c.get('/b', 0), b'bbbb')
+        self.assertEqual(c.size, 4)
+
+        c.invalidate()
+        self.assertEqual(c.get('/b', 0), None)
+        self.assertEqual(c.size, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
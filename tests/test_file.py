@@ -0,0 +1,233 @@
+import io
+import array
+import mmap
+import unittest
+import tempfile
+
+from concurrent import futures
+
+import fuse
+
+from mafs import file
+
+
+class FileReaderTests(unittest.TestCase):
+    def test_iterable(self):
+        parts = ['abc', 'def', '', 'ghij']
+        r = file.FileReader.create(iter(parts), 'utf-8')
+        self.assertIsInstance(r, file.FileReader.Iterable)
+
+        self.assertEqual(r.read(2, 0), b'ab')
+        self.assertEqual(r.read(4, 2), b'cdef')
+        self.assertEqual(r.read(100, 1), b'bcdefghij')
+        self.assertEqual(r.read(10, 10), b'')
+
+    def test_iterable_sequential(self):
+        parts = (str(i) * 4 for i in range(10))
+        r = file.FileReader.create(parts, 'utf-8', sequential=True)
+
+        self.assertEqual(r.read(6, 0), b'000011')
+        self.assertEqual(r.read(6, 6), b'112222')
+        self.assertEqual(r.read(6, 6), b'112222')
+        self.assertLessEqual(len(r.segments), 2)
+
+        self.assertEqual(r.read(20, 12), b'33334444555566667777')
+        with self.assertRaises(fuse.FuseOSError):
+            r.read(4, 0)
+
+    def test_file(self):
+        with tempfile.TemporaryFile() as f:
+            f.write(b'hello world')
+            f.flush()
+
+            r = file.FileReader.create(f, None)
+            self.assertIsInstance(r, file.FileReader.File)
+            self.assertIsNotNone(r.fd)
+            self.assertEqual(r.read(5, 6), b'world')
+            self.assertEqual(r.read(5, 20), b'')
+
+        # data still buffered in the file is read
+        with tempfile.TemporaryFile() as f:
+            f.write(b'unflushed')
+
+            r = file.FileReader.create(f, None)
+            self.assertEqual(r.read(100, 0), b'unflushed')
+
+        # files without a descriptor fall back to seeking
+        r = file.FileReader.create(io.StringIO('hello world'), 'utf-8')
+        self.assertIsNone(r.fd)
+        self.assertEqual(r.read(5, 0), b'hello')
+
+    def test_buffer(self):
+        for contents in (b'hello world', bytearray(b'hello world'),
+                         memoryview(b'hello world')):
+            r = file.FileReader.create(contents, 'utf-8')
+            self.assertIsInstance(r, file.FileReader.Buffer)
+            self.assertIsInstance(r.read(5, 6), memoryview)
+            self.assertEqual(r.read(5, 6), b'world')
+            self.assertEqual(r.read(5, 20), b'')
+
+        # multi-byte items are served as raw bytes
+        contents = array.array('H', [1, 2, 3])
+        r = file.FileReader.create(contents, None)
+        self.assertEqual(r.read(4, 2), contents.tobytes()[2:6])
+
+        # resizable buffers can still be resized while being read
+        contents = bytearray(b'hello')
+        r = file.FileReader.create(contents, None)
+        contents += b' world'
+        self.assertEqual(r.read(100, 0), b'hello')
+        r.release()
+
+    def test_mapped(self):
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(b'hello world')
+            f.flush()
+
+            r = file.FileReader.create(file.MemoryMap(f.name), None)
+            self.assertIsInstance(r, file.FileReader.Mapped)
+            self.assertEqual(r.read(5, 6), b'world')
+            self.assertEqual(r.read(5, 20), b'')
+            r.release()
+
+            r = file.FileReader.create(file.MemoryMap(f.fileno()), None)
+            self.assertEqual(r.read(5, 0), b'hello')
+            r.release()
+
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            r = file.FileReader.create(m, None)
+            self.assertIsInstance(r, file.FileReader.Mapped)
+            self.assertEqual(r.read(100, 0), b'hello world')
+            r.release()
+            self.assertTrue(m.closed)
+
+        # empty files cannot be mapped
+        with tempfile.NamedTemporaryFile() as f:
+            r = file.FileReader.create(file.MemoryMap(f.name), None)
+            self.assertEqual(r.read(5, 0), b'')
+
+    def test_readahead(self):
+        contents = bytes(range(256)) * 40
+        calls = []
+
+        def reader(length, offset):
+            calls.append(offset)
+            return contents[offset:offset + length]
+
+        executor = futures.ThreadPoolExecutor()
+        r = file.FileReader.create(reader, None)
+        r = file.FileReader.Readahead(r, executor, window=1000)
+
+        # sequential reads are served from data read ahead
+        data = bytes()
+        while True:
+            part = r.read(100, len(data))
+            if not part:
+                break
+            data += part
+        self.assertEqual(data, contents)
+        self.assertLess(len(calls), len(contents) // 100)
+
+        # other reads are still correct
+        self.assertEqual(r.read(50, 5000), contents[5000:5050])
+        self.assertEqual(r.read(50, 10), contents[10:60])
+        self.assertEqual(r.read(50, 10230), contents[10230:])
+        r.release()
+
+        # data added after the end was reached is still read
+        contents = bytearray(1500)
+        r = file.FileReader.create(reader, None)
+        r = file.FileReader.Readahead(r, executor, window=1000)
+        offset = 0
+        while True:
+            part = r.read(100, offset)
+            if not part:
+                break
+            offset += len(part)
+        self.assertEqual(offset, 1500)
+
+        contents += bytes(range(200))
+        self.assertEqual(r.read(100, offset), bytes(range(100)))
+        self.assertEqual(r.read(200, offset + 100), bytes(range(100, 200)))
+        r.release()
+        executor.shutdown()
+
+
+class FileWriterTests(unittest.TestCase):
+    def test_file(self):
+        with tempfile.TemporaryFile() as f:
+            f.write(b'buffered ')
+
+            w = file.FileWriter.create(f, None)
+            self.assertIsInstance(w, file.FileWriter.File)
+            self.assertIsNotNone(w.fd)
+            self.assertEqual(w.write(b'data', 9), 4)
+            self.assertEqual(w.write(b'more', 13), 4)
+
+            f.seek(0)
+            self.assertEqual(f.read(), b'buffered datamore')
+
+    def test_full(self):
+        results = []
+        w = file.FileWriter.create(results.append, 'utf-8')
+        self.assertIsInstance(w, file.FileWriter.Full)
+
+        self.assertEqual(w.write(b'world', 6), 5)
+        self.assertEqual(w.write(b'hello ', 0), 6)
+        self.assertEqual(w.write(b'!', 11), 1)
+        w.release()
+        self.assertEqual(results, ['hello world!'])
+
+        # gaps are filled with zeroes
+        results = []
+        w = file.FileWriter.create(results.append, None)
+        w.write(b'end', 4)
+        w.release()
+        self.assertEqual(results, [b'\x00\x00\x00\x00end'])
+
+    def test_full_spill(self):
+        results = []
+        w = file.FileWriter.create(results.append, None, spill_size=8)
+
+        w.write(b'abcd', 0)
+        self.assertIsNone(w.spill)
+        w.write(b'efgh', 6)
+        self.assertIsNotNone(w.spill)
+        w.write(b'XY', 4)
+        w.release()
+        self.assertEqual(results, [b'abcdXYefgh'])
+
+    def test_stream(self):
+        results = []
+
+        def sink():
+            try:
+                while True:
+                    results.append((yield))
+            except GeneratorExit:
+                results.append(None)
+
+        w = file.FileWriter.create(sink(), 'utf-8')
+        self.assertIsInstance(w, file.FileWriter.Stream)
+
+        w.write(b'hello', 0)
+        w.write(b'world', 6)
+        self.assertEqual(results, ['hello'])
+        w.write(b' ', 5)
+        self.assertEqual(results, ['hello', ' ', 'world'])
+
+        # partial characters wait for the rest of their bytes
+        w.write('\u00e9'.encode('utf-8')[:1], 11)
+        w.write('\u00e9'.encode('utf-8')[1:], 12)
+        self.assertEqual(results[-1], '\u00e9')
+
+        with self.assertRaises(fuse.FuseOSError):
+            w.write(b'again', 0)
+
+        w.write(b'end', 14)
+        w.release()
+        self.assertEqual(results[-3:], ['\x00', 'end', None])
+
+
+if __name__ == "__main__":
+    unittest.main()
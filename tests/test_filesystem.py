@@ -0,0 +1,387 @@
+import os
+import asyncio
+import stat
+import ctypes
+import itertools
+import unittest
+
+from types import SimpleNamespace
+
+from unittest import mock
+
+import fuse
+
+from mafs import filesystem
+
+
+def render(path, ps):
+    return ''.join('{} {}\n'.format(ps.file, i) for i in range(1000))
+
+
+@mock.patch('fuse.fuse_get_context', lambda: (1000, 1000, 1))
+class FileSystemTests(unittest.TestCase):
+    def test_getattr(self):
+        fs = filesystem.FileSystem()
+        fs.onread('/folder/file', lambda path, ps: 'contents')
+        fs.onreadlink('/link', lambda path, ps: './folder/file')
+
+        attrs = fs.getattr('/folder')
+        self.assertEqual(attrs['st_mode'], stat.S_IFDIR | 0o755)
+        self.assertEqual(attrs['st_uid'], 1000)
+
+        attrs = fs.getattr('/folder/file')
+        self.assertEqual(stat.S_IFMT(attrs['st_mode']), stat.S_IFREG)
+
+        attrs = fs.getattr('/link')
+        self.assertEqual(stat.S_IFMT(attrs['st_mode']), stat.S_IFLNK)
+
+        with self.assertRaises(fuse.FuseOSError):
+            fs.getattr('/missing')
+
+    def test_getattr_stat(self):
+        calls = []
+
+        def statter(path, ps):
+            calls.append(path)
+            if ps.file == 'missing':
+                raise FileNotFoundError()
+            return {'st_size': 42}
+
+        fs = filesystem.FileSystem()
+        fs.onread('/:file', lambda path, ps: 'contents')
+        fs.onstat('/:file', statter)
+
+        self.assertEqual(fs.getattr('/foo')['st_size'], 42)
+        self.assertEqual(fs.getattr('/foo')['st_size'], 42)
+        self.assertEqual(len(calls), 2)
+
+        with self.assertRaises(fuse.FuseOSError):
+            fs.getattr('/missing')
+
+    def test_getattr_stat_result(self):
+        fs = filesystem.FileSystem()
+        fs.onread('/file', lambda path, ps: 'contents')
+        fs.onstat('/file', lambda path, ps: os.stat(__file__))
+
+        attrs = fs.getattr('/file')
+        self.assertEqual(attrs['st_size'], os.stat(__file__).st_size)
+        self.assertEqual(attrs['st_mode'], os.stat(__file__).st_mode)
+
+    def test_getattr_size(self):
+        contents = ['hello']
+
+        fs = filesystem.FileSystem()
+        fs.onread('/text', lambda path, ps: contents[0])
+        fs.onread('/bytes', lambda path, ps: bytearray(10), None)
+        fs.onread('/generated', lambda path, ps: iter(['a', 'b']))
+
+        def writer(path, ps):
+            def write(data):
+                contents[0] = data
+            return write
+        fs.onwrite('/text', writer)
+
+        self.assertEqual(fs.getattr('/text')['st_size'], 5)
+        self.assertEqual(fs.getattr('/bytes')['st_size'], 10)
+        self.assertEqual(fs.getattr('/generated')['st_size'], 0)
+
+        # writes change the size
+        fi = SimpleNamespace(flags=os.O_WRONLY)
+        fs.open('/text', fi)
+        fs.write('/text', b'hello world', 0, fi)
+        fs.release('/text', fi)
+        self.assertEqual(fs.getattr('/text')['st_size'], 11)
+
+    def test_getattr_size_unknown(self):
+        calls = []
+
+        def failing(path, ps):
+            raise RuntimeError('cannot be read')
+
+        def cached(path, ps):
+            calls.append(path)
+            return 'contents'
+
+        fs = filesystem.FileSystem()
+        fs.onread('/failing', failing)
+        fs.onread('/invalid', lambda path, ps: 42)
+        fs.onread('/cached', cached, block_cache=True)
+
+        # files that cannot be sized are still stat-ed, and fail to open
+        self.assertEqual(fs.getattr('/failing')['st_size'], 0)
+        self.assertEqual(fs.getattr('/invalid')['st_size'], 0)
+        with self.assertRaises(RuntimeError):
+            fs.open('/failing', SimpleNamespace(flags=os.O_RDONLY))
+
+        # cached files are sized once their contents are produced
+        self.assertEqual(fs.getattr('/cached')['st_size'], 0)
+        self.assertEqual(calls, [])
+
+        fi = SimpleNamespace(flags=os.O_RDONLY)
+        fs.open('/cached', fi)
+        self.assertEqual(fs.read('/cached', 100, 0, fi), b'contents')
+        fs.release('/cached', fi)
+        self.assertEqual(fs.getattr('/cached')['st_size'], 8)
+        self.assertEqual(calls, ['/cached'])
+
+    def test_getattr_ttl(self):
+        calls = []
+
+        def statter(path, ps):
+            calls.append(path)
+            return {'st_size': len(calls)}
+
+        fs = filesystem.FileSystem()
+        fs.onread('/:file', lambda path, ps: 'contents')
+        fs.onstat('/:file', statter, ttl=60)
+
+        self.assertEqual(fs.getattr('/foo')['st_size'], 1)
+        self.assertEqual(fs.getattr('/foo')['st_size'], 1)
+        self.assertEqual(fs.getattr('/bar')['st_size'], 2)
+
+        fs.invalidate('/foo')
+        self.assertEqual(fs.getattr('/foo')['st_size'], 3)
+        self.assertEqual(fs.getattr('/bar')['st_size'], 2)
+
+    def test_readdir(self):
+        fs = filesystem.FileSystem()
+        fs.onread('/place/here', lambda path, ps: 'here')
+        fs.onread('/place/:any', lambda path, ps: 'anywhere')
+        fs.onreadlink('/shortcut', lambda path, ps: './place/here')
+
+        names = [name for name, _, _ in fs.readdir('/', None)]
+        self.assertEqual(names, ['.', '..', 'place', 'shortcut'])
+        names = [name for name, _, _ in fs.readdir('/place', None)]
+        self.assertEqual(names, ['.', '..', 'here'])
+
+    def test_readdir_offset(self):
+        produced = []
+
+        def lister(path, ps):
+            for i in range(1000):
+                produced.append(i)
+                yield str(i)
+
+        fs = filesystem.FileSystem()
+        fs.onlist('/', lister)
+
+        fh = fs.opendir('/')
+        entries = []
+        offset = 0
+        while True:
+            # read a page at a time, like the kernel does
+            page = list(itertools.islice(fs.readdir('/', fh, offset), 100))
+            if not page:
+                break
+            entries.extend(page)
+            offset = page[-1][2]
+        fs.releasedir('/', fh)
+
+        names = [name for name, _, _ in entries]
+        self.assertEqual(names, ['.', '..'] + [str(i) for i in range(1000)])
+        self.assertEqual(produced, list(range(1000)))
+
+    def test_readdir_ttl(self):
+        calls = []
+
+        def lister(path, ps):
+            calls.append(path)
+            return ['a', 'b']
+
+        fs = filesystem.FileSystem()
+        fs.onlist('/', lister, ttl=60)
+
+        for _ in range(3):
+            names = [name for name, _, _ in fs.readdir('/', None)]
+            self.assertEqual(names, ['.', '..', 'a', 'b'])
+        self.assertEqual(len(calls), 1)
+
+        fs.invalidate('/')
+        list(fs.readdir('/', None))
+        self.assertEqual(len(calls), 2)
+
+    def test_readdir_attrs(self):
+        stats = []
+
+        def statter(path, ps):
+            stats.append(path)
+            return {'st_size': 0}
+
+        fs = filesystem.FileSystem()
+        fs.onread('/:file', lambda path, ps: 'contents')
+        fs.onstat('/:file', statter)
+        fs.onwrite('/c', lambda path, ps: lambda data: None)
+        fs.onlist('/', lambda path, ps: [('a', {'st_size': 1}),
+                                         ('b', {'st_size': 2}),
+                                         ('c', {'st_size': 3})])
+
+        entries = {name: attrs for name, attrs, _ in fs.readdir('/', None)}
+        self.assertEqual(entries['.'], None)
+        self.assertEqual(entries['a']['st_size'], 1)
+        self.assertEqual(stat.S_IFMT(entries['a']['st_mode']), stat.S_IFREG)
+
+        # entries matching other routes have their own permissions
+        self.assertFalse(entries['b']['st_mode'] & stat.S_IWUSR)
+        self.assertTrue(entries['c']['st_mode'] & stat.S_IWUSR)
+        self.assertEqual(entries['c']['st_size'], 3)
+
+        self.assertEqual(fs.getattr('/a')['st_size'], 1)
+        self.assertEqual(fs.getattr('/b')['st_size'], 2)
+        self.assertEqual(stats, [])
+
+    def test_read_buffer(self):
+        contents = bytes(range(256))
+        fs = filesystem.FileSystem()
+        fs.onread('/bytes', lambda path, ps: contents, None)
+        fs.onread('/bytearray', lambda path, ps: bytearray(contents), None)
+
+        fi = SimpleNamespace(flags=os.O_RDONLY)
+        fs.open('/bytes', fi)
+        self.assertIs(fs.read('/bytes', 300, 0, fi), contents)
+        fs.release('/bytes', fi)
+
+        # buffers are handed to fuse without copying them
+        for path in ('/bytes', '/bytearray'):
+            fi = SimpleNamespace(flags=os.O_RDONLY)
+            fs.open(path, fi)
+            self.assertEqual(fs.read(path, 300, 0, fi), contents)
+            data = fs.read(path, 100, 50, fi)
+            self.assertIsInstance(data, ctypes.Array)
+            self.assertEqual(bytes(data), contents[50:150])
+            fs.release(path, fi)
+
+    def test_read_block_cache(self):
+        calls = []
+
+        def reader(path, ps):
+            def read(length, offset):
+                calls.append((length, offset))
+                return bytes(range(offset, min(offset + length, 200)))
+            return read
+
+        fs = filesystem.FileSystem()
+        fs.blocks.block_size = 64
+        fs.onread('/file', reader, None, block_cache=True)
+
+        for _ in range(2):
+            fi = SimpleNamespace(flags=os.O_RDONLY)
+            fs.open('/file', fi)
+            self.assertEqual(fs.read('/file', 10, 60, fi),
+                             bytes(range(60, 70)))
+            self.assertEqual(fs.read('/file', 100, 150, fi),
+                             bytes(range(150, 200)))
+            fs.release('/file', fi)
+
+        # the final block is short, so is read until the end of the file
+        self.assertEqual(calls, [(64, 0), (64, 64), (64, 128), (64, 192),
+                                 (56, 200)])
+
+        fs.invalidate('/file')
+        fi = SimpleNamespace(flags=os.O_RDONLY)
+        fs.open('/file', fi)
+        fs.read('/file', 10, 0, fi)
+        self.assertEqual(len(calls), 6)
+
+    def test_async(self):
+        written = []
+
+        async def reader(path, ps):
+            for part in ('hello', ' ', 'world'):
+                await asyncio.sleep(0)
+                yield part
+
+        async def writer(path, ps):
+            async def sink():
+                try:
+                    while True:
+                        written.append((yield))
+                except GeneratorExit:
+                    written.append(None)
+            return sink()
+
+        async def statter(path, ps):
+            return {'st_size': 11}
+
+        async def lister(path, ps):
+            async def names():
+                yield 'file'
+            return names()
+
+        fs = filesystem.FileSystem()
+        fs.onread('/file', reader)
+        fs.onwrite('/file', writer)
+        fs.onstat('/file', statter)
+        fs.onlist('/', lister)
+
+        try:
+            self.assertEqual(fs.getattr('/file')['st_size'], 11)
+
+            names = [name for name, _, _ in fs.readdir('/', None)]
+            self.assertEqual(names, ['.', '..', 'file'])
+
+            fi = SimpleNamespace(flags=os.O_RDONLY)
+            fs.open('/file', fi)
+            self.assertEqual(fs.read('/file', 100, 0, fi), b'hello world')
+            fs.release('/file', fi)
+
+            fi = SimpleNamespace(flags=os.O_WRONLY)
+            fs.open('/file', fi)
+            fs.write('/file', b'data', 0, fi)
+            fs.release('/file', fi)
+            self.assertEqual(written, ['data', None])
+        finally:
+            fs.destroy('/')
+
+    def test_process(self):
+        fs = filesystem.FileSystem(processes=2)
+        fs.onread('/:file', render, process=True)
+        self.assertTrue(fs.processes.required)
+
+        try:
+            fs.init('/')
+            self.assertIsNotNone(fs.processes.pool)
+
+            fi = SimpleNamespace(flags=os.O_RDONLY)
+            fs.open('/foo', fi)
+            expected = render('/foo', SimpleNamespace(file='foo')).encode()
+            self.assertEqual(bytes(fs.read('/foo', 100, 50, fi)),
+                             expected[50:150])
+            self.assertEqual(bytes(fs.read('/foo', 10, len(expected), fi)),
+                             b'')
+            fs.release('/foo', fi)
+        finally:
+            fs.destroy('/')
+
+    def test_metrics(self):
+        fs = filesystem.FileSystem(metrics=True)
+        fs.onread('/files/:name', lambda path, ps: 'contents')
+
+        fi = SimpleNamespace(flags=os.O_RDONLY)
+        fs('getattr', '/files/foo')
+        fs('open', '/files/foo', fi)
+        fs('read', '/files/foo', 4, 0, fi)
+        fs('read', '/files/foo', 100, 4, fi)
+        fs('release', '/files/foo', fi)
+        list(fs('readdir', '/files', None))
+        with self.assertRaises(fuse.FuseOSError):
+            fs('getattr', '/missing')
+
+        snapshot = fs.metrics.snapshot()
+        read = snapshot['read']['/files/:name']
+        self.assertEqual(read['count'], 2)
+        self.assertEqual(read['bytes'], 8)
+        self.assertEqual(read['latency'][-1][1], 2)
+        self.assertEqual(snapshot['open']['/files/:name']['count'], 1)
+        self.assertEqual(snapshot['readdir']['/files']['count'], 1)
+        self.assertEqual(snapshot['getattr'][None]['errors'], 1)
+
+        self.assertIn('mafs_bytes_total{operation="read",'
+                      'route="/files/:name"} 8', fs.metrics.render())
+
+        # metrics are only enabled once
+        self.assertIs(fs.enable_metrics(), fs.metrics)
+        self.assertEqual(fs.hooks, [fs.metrics])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,129 @@
+import os
+import unittest
+import tempfile
+from unittest import mock
+from types import SimpleNamespace
+
+import fuse
+
+from mafs import filesystem
+from mafs import hooks
+
+
+class RecordingHook(hooks.Hook):
+    def __init__(self):
+        self.calls = []
+
+    def before(self, op, path, route, args):
+        return (op, path)
+
+    def after(self, op, path, route, state, duration, result=None,
+              error=None):
+        self.calls.append((op, route, state, result, type(error)))
+
+
+@mock.patch('fuse.fuse_get_context', lambda: (1000, 1000, 1))
+class HookTests(unittest.TestCase):
+    def test_hook(self):
+        fs = filesystem.FileSystem()
+        fs.onreadlink('/links/:name', lambda path, ps: '/' + ps.name)
+
+        hook = RecordingHook()
+        fs.add_hook(hook)
+
+        self.assertEqual(fs('readlink', '/links/foo'), '/foo')
+        with self.assertRaises(fuse.FuseOSError):
+            fs('getattr', '/missing')
+        list(fs('readdir', '/links', None))
+
+        self.assertEqual(hook.calls, [
+            ('readlink', '/links/:name', ('readlink', '/links/foo'), '/foo',
+             type(None)),
+            ('getattr', None, ('getattr', '/missing'), None,
+             fuse.FuseOSError),
+            ('readdir', '/links', ('readdir', '/links'), None, type(None)),
+        ])
+
+    def test_hook_failure(self):
+        class FailingHook(hooks.Hook):
+            def before(self, op, path, route, args):
+                if op == 'readlink':
+                    raise RuntimeError('before')
+
+            def after(self, op, path, route, state, duration, result=None,
+                      error=None):
+                raise RuntimeError('after')
+
+        fs = filesystem.FileSystem()
+        fs.onreadlink('/links/:name', lambda path, ps: '/' + ps.name)
+
+        hook = RecordingHook()
+        fs.add_hook(FailingHook())
+        fs.add_hook(hook)
+
+        # failing hooks do not fail the operation, or other hooks
+        with self.assertLogs('mafs.filesystem') as logs:
+            self.assertEqual(fs('readlink', '/links/foo'), '/foo')
+            self.assertEqual(len(list(fs('readdir', '/links', None))), 2)
+        self.assertEqual(len(logs.records), 2)
+        self.assertEqual(len(hook.calls), 2)
+
+    def test_profiler(self):
+        def reader(path, ps):
+            return ''.join(str(i) for i in range(1000))
+
+        fs = filesystem.FileSystem()
+        fs.onread('/files/:name', reader)
+
+        with tempfile.TemporaryDirectory() as directory:
+            profiler = hooks.Profiler(directory)
+            fs.add_hook(profiler)
+
+            fi = SimpleNamespace(flags=os.O_RDONLY)
+            fs('open', '/files/foo', fi)
+            fs('read', '/files/foo', 10, 0, fi)
+            fs('release', '/files/foo', fi)
+
+            stats = profiler.stats()
+            self.assertEqual(list(stats), ['/files/:name'])
+            self.assertIn('reader', profiler.report())
+
+            fs('destroy', '/')
+            self.assertIn('%2Ffiles%2F%3Aname.prof', os.listdir(directory))
+
+    def test_profiler_exclusive(self):
+        first = hooks.Profiler()
+        second = hooks.Profiler()
+
+        # only one operation in the process is profiled at a time
+        state = first.before('read', '/file', '/file', ())
+        self.assertIsNotNone(state)
+        self.assertIsNone(first.before('read', '/file', '/file', ()))
+        self.assertIsNone(second.before('read', '/file', '/file', ()))
+        first.after('read', '/file', '/file', state, 0.0)
+
+        state = second.before('read', '/file', '/file', ())
+        self.assertIsNotNone(state)
+        second.after('read', '/file', '/file', state, 0.0)
+
+    def test_allocation_tracer(self):
+        fs = filesystem.FileSystem()
+        fs.onread('/file', lambda path, ps: 'x' * 100000)
+
+        tracer = hooks.AllocationTracer()
+        fs.add_hook(tracer)
+        try:
+            fi = SimpleNamespace(flags=os.O_RDONLY)
+            fs('open', '/file', fi)
+            fs('release', '/file', fi)
+
+            stats = tracer.routes['/file']
+            self.assertEqual(stats['count'], 2)
+            self.assertGreaterEqual(stats['largest'], 100000)
+            self.assertIn('/file: 2 operations', tracer.report())
+        finally:
+            fs('destroy', '/')
+
+
+if __name__ == "__main__":
+    unittest.main()
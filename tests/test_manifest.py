@@ -0,0 +1,140 @@
+import io
+import os
+import errno
+import stat
+import unittest
+from unittest import mock
+from types import SimpleNamespace
+
+import fuse
+
+from mafs import filesystem
+from mafs import manifest
+
+
+class ManifestTests(unittest.TestCase):
+    def test_lookup(self):
+        m = manifest.Manifest({
+            '/a/b/c': 'abc',
+            '/a/b.txt': 3,
+            'a/d': None,
+            '/e': b'e',
+        })
+
+        self.assertEqual(len(m), 4)
+        self.assertEqual(m.get('/a/b/c'), 'abc')
+        self.assertEqual(m.get(('a', 'b.txt')), 3)
+        self.assertIn('/a/d', m)
+        self.assertNotIn('/a/b', m)
+        self.assertEqual(m.get('/missing', 'default'), 'default')
+
+        self.assertTrue(m.isdir('/'))
+        self.assertTrue(m.isdir('/a/b'))
+        self.assertFalse(m.isdir('/a/b/c'))
+        self.assertFalse(m.isdir('/a/bb'))
+
+    def test_list(self):
+        m = manifest.Manifest([
+            ('/dir/a/1', 1), ('/dir/a/2', 2), ('/dir/a.b', 3),
+            ('/dir/a0', 4), ('/dir/b', 5), ('/other', 6),
+        ])
+
+        # entries are in the order of their full paths
+        self.assertEqual(list(m.list('/dir')), [
+            ('a.b', 3, False), ('a', None, True), ('a0', 4, False),
+            ('b', 5, False),
+        ])
+        self.assertEqual([name for name, _, _ in m.list('/')],
+                         ['dir', 'other'])
+        self.assertEqual(list(m.list('/missing')), [])
+
+    def test_conflicts(self):
+        with self.assertRaises(manifest.ManifestError):
+            manifest.Manifest([('/a', 1), ('/a', 2)])
+        with self.assertRaises(manifest.ManifestError):
+            manifest.Manifest([('/a', 1), ('/a.b', 2), ('/a/c', 3)])
+
+    def test_load(self):
+        m = manifest.Manifest.load(io.StringIO('/a/b\t10\n/c\n\n'))
+        self.assertEqual(m.get('/a/b'), 10)
+        self.assertEqual(m.get('/c'), None)
+        self.assertIn('/c', m)
+
+    def test_normalize(self):
+        # paths listed by find, or with redundant components, are accepted
+        m = manifest.Manifest.load(io.StringIO(
+            './a/b.txt\t5\n.//c//d\t1\na/../e/./f\n'))
+        self.assertEqual(m.paths, ('a/b.txt', 'c/d', 'e/f'))
+        self.assertEqual(m.get('/a/b.txt'), 5)
+        self.assertEqual(m.get('./c/d'), 1)
+        self.assertTrue(m.isdir('e/.'))
+        self.assertEqual([name for name, _, _ in m.list('.')],
+                         ['a', 'c', 'e'])
+
+
+@mock.patch('fuse.fuse_get_context', lambda: (1000, 1000, 1))
+class ManifestFileSystemTests(unittest.TestCase):
+    def test_manifest(self):
+        m = manifest.Manifest({
+            '/a/b/c': 'abc',
+            '/a/big': 1000,
+        })
+
+        calls = []
+
+        def reader(path, ps):
+            calls.append(ps.path)
+            return 'x' * 1000
+
+        fs = filesystem.FileSystem()
+        fs.onmanifest('/data', m)
+        fs.onmanifest('/sized', m, reader)
+
+        attrs = fs.getattr('/data/a/b')
+        self.assertEqual(stat.S_IFMT(attrs['st_mode']), stat.S_IFDIR)
+        attrs = fs.getattr('/data/a/b/c')
+        self.assertEqual(stat.S_IFMT(attrs['st_mode']), stat.S_IFREG)
+        self.assertEqual(attrs['st_size'], 3)
+        self.assertEqual(fs.getattr('/sized/a/big')['st_size'], 1000)
+        with self.assertRaises(fuse.FuseOSError):
+            fs.getattr('/data/a/missing')
+
+        entries = {name: attrs for name, attrs, _ in fs.readdir('/data', None)}
+        self.assertEqual(sorted(entries), ['.', '..', 'a'])
+        entries = {name: attrs
+                   for name, attrs, _ in fs.readdir('/data/a', None)}
+        self.assertEqual(stat.S_IFMT(entries['b']['st_mode']), stat.S_IFDIR)
+        self.assertEqual(entries['big']['st_size'], 1000)
+
+        fi = SimpleNamespace(flags=os.O_RDONLY)
+        fs.open('/data/a/b/c', fi)
+        self.assertEqual(fs.read('/data/a/b/c', 10, 1, fi), b'bc')
+        fs.release('/data/a/b/c', fi)
+
+        fs.open('/sized/a/big', fi)
+        self.assertEqual(len(fs.read('/sized/a/big', 4096, 0, fi)), 1000)
+        fs.release('/sized/a/big', fi)
+        self.assertEqual(calls, [('a', 'big')])
+
+    def test_manifest_missing(self):
+        fs = filesystem.FileSystem()
+        fs.onmanifest('/data', manifest.Manifest({}))
+
+        # an empty manifest is still an empty directory
+        attrs = fs.getattr('/data')
+        self.assertEqual(stat.S_IFMT(attrs['st_mode']), stat.S_IFDIR)
+        names = [name for name, _, _ in
+                 fs.readdir('/data', fs.opendir('/data'))]
+        self.assertEqual(names, ['.', '..'])
+
+        # missing files fail as missing, wherever they are used
+        with self.assertRaises(fuse.FuseOSError) as raised:
+            list(fs.readdir('/data/missing', None))
+        self.assertEqual(raised.exception.errno, errno.ENOENT)
+        with self.assertRaises(fuse.FuseOSError) as raised:
+            fs.open('/data/missing', SimpleNamespace(flags=os.O_RDONLY))
+        self.assertEqual(raised.exception.errno, errno.ENOENT)
+
+
+if __name__ == "__main__":
+    unittest.main()
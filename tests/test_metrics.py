@@ -0,0 +1,42 @@
+import unittest
+
+from mafs import metrics
+
+
+class MetricsTests(unittest.TestCase):
+    def test_record(self):
+        m = metrics.Metrics()
+        m.record('read', '/:file', 0.0002, size=10)
+        m.record('read', '/:file', 2, size=5)
+        m.record('read', '/:file', 20, error=True)
+        m.record('open', '/:file', 0.00001)
+
+        read = m.snapshot()['read']['/:file']
+        self.assertEqual(read['count'], 3)
+        self.assertEqual(read['errors'], 1)
+        self.assertEqual(read['bytes'], 15)
+
+        latency = dict(read['latency'])
+        self.assertEqual(latency[0.0001], 0)
+        self.assertEqual(latency[0.0005], 1)
+        self.assertEqual(latency[5], 2)
+        self.assertEqual(latency[float('inf')], 3)
+
+        m.clear()
+        self.assertEqual(m.snapshot(), {})
+
+    def test_render(self):
+        m = metrics.Metrics()
+        m.record('read', '/"quoted"', 0.5, size=3)
+
+        text = m.render()
+        self.assertIn('mafs_operations_total{operation="read",'
+                      'route="/\\"quoted\\""} 1\n', text)
+        self.assertIn('mafs_latency_seconds_bucket{operation="read",'
+                      'route="/\\"quoted\\"",le="+Inf"} 1\n', text)
+        self.assertIn('mafs_latency_seconds_sum{operation="read",'
+                      'route="/\\"quoted\\""} 0.5\n', text)
+
+
+if __name__ == "__main__":
+    unittest.main()
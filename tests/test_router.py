@@ -1,3 +1,4 @@
+import sys
 import unittest
 
 from mafs import router
@@ -78,6 +79,122 @@ class RouterTests(unittest.TestCase):
 
         self.assertEqual(r.list('/').data, ['foo', 'bar', 'baz'])
 
+    def test_lookup_route(self):
+        r = router.Router()
+        r.add('/files/:name', 'in files')
+        r.add('/deep/*path', 'in deep')
+
+        self.assertEqual(r.lookup('/files/foo').route, '/files/:name')
+        self.assertEqual(r.lookup('/deep/a/b').route, '/deep/*path')
+        self.assertEqual(r.lookup('/files').route, '/files')
+        self.assertEqual(r.lookup('/').route, '/')
+
+    def test_lookup_cache(self):
+        r = router.Router()
+        r.add('/foo/:file', 'in foo')
+
+        first = r.lookup('/foo/bar')
+        self.assertIs(r.lookup('/foo/bar'), first)
+        self.assertEqual(r.lookup('/missing'), None)
+        self.assertEqual(r.lookup('/missing'), None)
+
+        info = r.cache_info()
+        self.assertEqual(info.hits, 2)
+        self.assertEqual(info.misses, 2)
+
+        # results are shared, so must not be modified
+        with self.assertRaises(AttributeError):
+            first.data = 'modified'
+
+        # adding a route invalidates previous lookups
+        r.add('/missing', 'in missing')
+        self.assertEqual(r.lookup('/missing').data, 'in missing')
+        self.assertEqual(r.cache_info().currsize, 1)
+
+    def test_lookup_cache_size(self):
+        r = router.Router(cache_size=2)
+        r.add('/:file', 'in file')
+
+        for path in ('/a', '/b', '/c', '/a'):
+            r.lookup(path)
+
+        info = r.cache_info()
+        self.assertEqual(info.hits, 0)
+        self.assertEqual(info.currsize, 2)
+
+    def test_resolve(self):
+        r = router.Router(keys=['read', 'stat'])
+        r.add('/foo/here', 'read here', 'read')
+        r.add('/foo/:file', 'read file', 'read')
+        r.add('/foo/*path', 'stat path', 'stat')
+
+        result = r.resolve('/foo/here')
+        self.assertEqual(result['read'].data, 'read here')
+        self.assertEqual(result['stat'].data, 'stat path')
+        self.assertEqual(result['stat'].parameters.path, ('here',))
+
+        result = r.resolve('/foo/there/again')
+        self.assertNotIn('read', result)
+        self.assertEqual(result['stat'].data, 'stat path')
+
+        # keys are independent of each other
+        self.assertEqual(r.lookup('/foo/other', 'read').data, 'read file')
+        self.assertEqual(r.lookup('/foo/other', 'stat').data, 'stat path')
+        self.assertEqual(r.list('/foo', 'read').data, ['here'])
+        self.assertEqual(r.list('/foo', 'stat').data, [])
+
+        # the root matches every key
+        result = r.resolve('/')
+        self.assertEqual(set(result.keys()), {'read', 'stat'})
+
+    def test_lookup_deep(self):
+        depth = sys.getrecursionlimit() + 100
+        parts = ['part{}'.format(i) for i in range(depth)]
+
+        # deep static routes
+        r = router.Router()
+        r.add('/'.join(parts), 'in deep')
+        self.assertEqual(r.lookup('/'.join(parts)).data, 'in deep')
+        self.assertEqual(r.lookup('/'.join(parts[:-1])).data, None)
+        self.assertEqual(r.lookup('/'.join(parts + ['extra'])), None)
+
+        # deep paths under recursive routes
+        r = router.Router()
+        r.add('/*head/middle/*tail/end', 'in middle')
+        r.add('/other/*path', 'in path')
+
+        path = parts[:300] + ['middle'] + parts[300:600] + ['end']
+        result = r.lookup('/'.join(path))
+        self.assertEqual(result.data, 'in middle')
+        self.assertEqual(result.parameters.head, tuple(parts[:300]))
+        self.assertEqual(result.parameters.tail, tuple(parts[300:600]))
+
+        path = parts[:300] + ['middle'] + parts[300:600]
+        result = r.lookup('/'.join(['other'] + path))
+        self.assertEqual(result.data, 'in path')
+        self.assertEqual(result.parameters.path, tuple(path))
+
+    def test_lookup_precedence(self):
+        r = router.Router()
+        r.add('/*path/end', 'in recursive')
+        r.add('/:dir/end', 'in variable')
+        r.add('/static/end', 'in static')
+
+        self.assertEqual(r.lookup('/static/end').data, 'in static')
+        self.assertEqual(r.lookup('/other/end').data, 'in variable')
+        self.assertEqual(r.lookup('/static/other/end').data, 'in recursive')
+
+        # recursive variables match as little as possible
+        result = r.lookup('/a/b/end/end')
+        self.assertEqual(result.data, 'in recursive')
+        self.assertEqual(result.parameters.path, ('a', 'b', 'end'))
+
+        r = router.Router()
+        r.add('/*first/*second', 'in recursive')
+        result = r.lookup('/a/b/c')
+        self.assertEqual(result.parameters.first, ('a',))
+        self.assertEqual(result.parameters.second, ('b', 'c'))
+
 
 if __name__ == "__main__":
     unittest.main()
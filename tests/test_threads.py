@@ -0,0 +1,152 @@
+import os
+import time
+import unittest
+import threading
+
+from types import SimpleNamespace
+from unittest import mock
+from concurrent.futures import ThreadPoolExecutor
+
+from mafs import filesystem
+
+THREADS = 16
+ROUNDS = 200
+
+
+@mock.patch('fuse.fuse_get_context', lambda: (1000, 1000, 1))
+class ThreadTests(unittest.TestCase):
+    def setUp(self):
+        self.fs = filesystem.FileSystem()
+        self.written = {}
+
+        def numbers(path, ps):
+            for i in range(1000):
+                yield '{:>4}\n'.format(i)
+
+        def writer(path, ps):
+            def callback(contents):
+                self.written[path] = contents
+            return callback
+
+        self.expected = ''.join('{:>4}\n'.format(i) for i in range(1000))
+        self.fs.onread('/numbers', numbers)
+        self.fs.onread('/cached/:file', lambda path, ps: path * 100,
+                       block_cache=True)
+        self.fs.onread('/static/:file', lambda path, ps: b'x' * 100)
+        self.fs.onwrite('/upload/:file', writer)
+        self.fs.onstat('/cached/:file', lambda path, ps: {'st_size': 1},
+                       ttl=60)
+
+    def tearDown(self):
+        self.fs.destroy('/')
+
+    def run_threads(self, func, count=THREADS):
+        with ThreadPoolExecutor(count) as pool:
+            results = list(pool.map(func, range(count)))
+        return results
+
+    def read_all(self, path, chunk=100):
+        fi = SimpleNamespace(flags=os.O_RDONLY)
+        self.fs.open(path, fi)
+        try:
+            data = bytearray()
+            while True:
+                part = self.fs.read(path, chunk, len(data), fi)
+                if not part:
+                    return fi.fh, bytes(data)
+                data += part
+        finally:
+            self.fs.release(path, fi)
+
+    def test_handles(self):
+        def run(n):
+            return [self.read_all('/static/{}'.format(n))[0]
+                    for _ in range(ROUNDS)]
+
+        handles = [fh for fhs in self.run_threads(run) for fh in fhs]
+        self.assertEqual(len(handles), len(set(handles)))
+        self.assertEqual(self.fs.readers, {})
+
+    def test_read(self):
+        def run(n):
+            for i in range(ROUNDS // 10):
+                _, data = self.read_all('/numbers', chunk=7 + n)
+                self.assertEqual(data.decode(), self.expected)
+
+                path = '/cached/{}'.format(i % 4)
+                _, data = self.read_all(path)
+                self.assertEqual(data.decode(), path * 100)
+
+        self.run_threads(run)
+
+    def test_shared_handle(self):
+        # many threads reading different parts of one open file
+        fi = SimpleNamespace(flags=os.O_RDONLY)
+        self.fs.open('/numbers', fi)
+
+        def run(n):
+            for i in range(ROUNDS):
+                offset = ((n * ROUNDS + i) * 5) % 5000
+                data = self.fs.read('/numbers', 5, offset, fi)
+                expected = self.expected[offset:offset + 5]
+                self.assertEqual(data.decode(), expected)
+
+        self.run_threads(run)
+        self.fs.release('/numbers', fi)
+
+    def test_metadata(self):
+        def run(n):
+            for i in range(ROUNDS):
+                path = '/cached/{}'.format(i % 8)
+                self.assertEqual(self.fs.getattr(path)['st_size'], 1)
+                self.fs.getattr('/static/{}'.format(n))
+                if i % 10 == 0:
+                    self.fs.invalidate(path)
+
+                fh = self.fs.opendir('/')
+                names = [name for name, _, _ in self.fs.readdir('/', fh)]
+                self.fs.releasedir('/', fh)
+                self.assertIn('numbers', names)
+
+        self.run_threads(run)
+
+    def test_write(self):
+        def run(n):
+            path = '/upload/{}'.format(n)
+            fi = SimpleNamespace(flags=os.O_WRONLY)
+            self.fs.open(path, fi)
+            for i in reversed(range(100)):
+                self.fs.write(path, '{:>3}'.format(i).encode(), i * 3, fi)
+            self.fs.release(path, fi)
+
+        self.run_threads(run)
+
+        expected = ''.join('{:>3}'.format(i) for i in range(100))
+        for n in range(THREADS):
+            self.assertEqual(self.written['/upload/{}'.format(n)], expected)
+
+    def test_slow_callback(self):
+        # a slow callback should not hold up reads of other files
+        release = threading.Event()
+
+        def slow(path, ps):
+            release.wait(10)
+            return 'slow'
+
+        self.fs.onread('/slow', slow)
+
+        with ThreadPoolExecutor(2) as pool:
+            future = pool.submit(self.read_all, '/slow')
+
+            start = time.monotonic()
+            for _ in range(ROUNDS):
+                self.read_all('/static/fast')
+            self.assertLess(time.monotonic() - start, 5)
+            self.assertFalse(future.done())
+
+            release.set()
+            self.assertEqual(future.result()[1], b'slow')
+
+
+if __name__ == "__main__":
+    unittest.main()
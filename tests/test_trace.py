@@ -0,0 +1,103 @@
+import os
+import unittest
+import tempfile
+from unittest import mock
+from types import SimpleNamespace
+
+import fuse
+
+from mafs import filesystem
+from mafs import trace
+
+
+def _filesystem(reads):
+    def reader(path, ps):
+        def read(length, offset):
+            reads.append((path, length, offset))
+            return bytes(length)
+        return read
+
+    fs = filesystem.FileSystem()
+    fs.onread('/files/:name', reader)
+    return fs
+
+
+class TraceTests(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'trace')
+
+    @mock.patch('fuse.fuse_get_context', lambda: (1000, 1000, 1))
+    def record(self):
+        fs = _filesystem([])
+        fs.add_hook(trace.Recorder(self.path))
+
+        fs('getattr', '/files/foo')
+        with self.assertRaises(fuse.FuseOSError):
+            fs('getattr', '/missing')
+
+        fi = SimpleNamespace(flags=os.O_RDONLY)
+        fs('open', '/files/foo', fi)
+        fs('read', '/files/foo', 100, 0, fi)
+        fs('read', '/files/foo', 100, 4096, fi)
+        fs('release', '/files/foo', fi)
+
+        fh = fs('opendir', '/files')
+        list(fs('readdir', '/files', fh, 0))
+        fs('releasedir', '/files', fh)
+
+        fs('destroy', '/')
+        return fi.fh
+
+    def test_record(self):
+        fh = self.record()
+
+        records = list(trace.read(self.path))
+        self.assertEqual([(r.op, r.path) for r in records], [
+            ('getattr', '/files/foo'),
+            ('getattr', '/missing'),
+            ('open', '/files/foo'),
+            ('read', '/files/foo'),
+            ('read', '/files/foo'),
+            ('release', '/files/foo'),
+            ('opendir', '/files'),
+            ('readdir', '/files'),
+            ('releasedir', '/files'),
+        ])
+
+        self.assertFalse(records[0].error)
+        self.assertTrue(records[1].error)
+        self.assertEqual(records[2].handle, fh)
+        self.assertEqual(records[2].flags, os.O_RDONLY)
+        self.assertEqual(records[4].offset, 4096)
+        self.assertEqual(records[4].length, 100)
+        self.assertEqual(records[4].handle, fh)
+        self.assertLessEqual(records[3].start, records[4].start)
+
+    def test_read_truncated(self):
+        self.record()
+        with open(self.path, 'r+b') as f:
+            f.truncate(os.path.getsize(self.path) - 1)
+
+        self.assertEqual(len(list(trace.read(self.path))), 8)
+
+    def test_replay(self):
+        self.record()
+
+        for concurrency in [1, 3]:
+            reads = []
+            fs = _filesystem(reads)
+            summary = trace.replay(fs, trace.read(self.path), speed=None,
+                                   concurrency=concurrency)
+
+            self.assertEqual(summary['operations'], 9)
+            self.assertEqual(summary['errors'], 1)
+            self.assertEqual(reads, [('/files/foo', 100, 0),
+                                     ('/files/foo', 100, 4096)])
+            self.assertEqual(fs.readers, {})
+            self.assertEqual(fs.directories, {})
+
+
+if __name__ == "__main__":
+    unittest.main()